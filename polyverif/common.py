@@ -8,7 +8,6 @@ from functools import reduce
 
 import numpy as np
 from bitstring import Bits, BitArray, BitStream, ConstBitStream
-import bitarray
 import types
 import os
 import sys
@@ -16,20 +15,43 @@ import math
 import random
 import logging
 import hashlib
+import atexit
+import sqlite3
+import filelock
 import crypto_util
 import scipy.misc
 import ufx.uf_hash as ufh
 import subprocess
 import signal
+import multiprocessing
+import psutil
+from multiprocessing.pool import ThreadPool
 from repoze.lru import lru_cache, LRUCache
 from crypto_util import aes_ctr, get_zero_vector
 
+try:
+    import bitarray
+except ImportError:
+    bitarray = None
+
 
 # Enables bitarray - with native C extension
-FAST_IMPL = True
+FAST_IMPL = bitarray is not None
 
 # Enables bitarray - with native C extension with eval_monic()
-FAST_IMPL_PH4 = True
+FAST_IMPL_PH4 = FAST_IMPL and hasattr(bitarray.bitarray, 'eval_monic')
+
+# numpy >= 2.0 has native vectorized popcount
+NP_BITWISE_COUNT = hasattr(np, 'bitwise_count')
+
+# Term evaluator shared with the forked worker processes, copy-on-write
+_FORK_TERM_EVAL = None
+
+# Maximal block length for the histogram engine, 2^blocklen histogram bins
+HIST_MAX_BLOCKLEN = 24
+
+# Process-wide cache of the expected probabilities, see get_expp_cache()
+_EXPP_CACHE = None
 
 
 logger = logging.getLogger(__name__)
@@ -72,7 +94,7 @@ def pos_generator(spec=None, dim=None, maxelem=None):
             return
 
 
-def term_generator(deg, maxelem, prob_choose=1.0):
+def term_generator(deg, maxelem, prob_choose=1.0, first=0, count=None):
     """
     Generates all terms of the given degree with given max len.
 
@@ -81,19 +103,30 @@ def term_generator(deg, maxelem, prob_choose=1.0):
     :param deg:
     :param maxelem:
     :param prob_choose: probability the given element will be chosen
+    :param first: rank of the first term to start with
+    :param count: number of terms to go through from the first one, all if None
     :return:
     """
+    if prob_choose < 1.0:
+        for term in term_sample_generator(deg, maxelem, prob_choose, first, count):
+            yield term
+        return
+
     idx = [0] * deg
     for i in range(deg):
         idx[i] = i
         if i > maxelem:
             raise ValueError('deg too big for the maxelem')
+    if first > 0:
+        idx = list(unrank(first, maxelem + 1, deg))
 
     while True:
-        if prob_choose >= 1.0:
-            yield list(idx)
-        elif random.random() < prob_choose:
-            yield list(idx)
+        if count is not None:
+            if count <= 0:
+                return
+            count -= 1
+
+        yield list(idx)
 
         # increment with overflow
         c = deg - 1
@@ -111,6 +144,78 @@ def term_generator(deg, maxelem, prob_choose=1.0):
             return
 
 
+def sample_ranks(total, num):
+    """
+    Floyd's sampling of num distinct ranks from [0, total) without replacement.
+    :param total:
+    :param num:
+    :return: sorted list of ranks
+    """
+    res = set()
+    for j in xrange(total - num, total):
+        t = random.randint(0, j)
+        res.add(j if t in res else t)
+    return sorted(res)
+
+
+def term_sample_generator(deg, maxelem, prob_choose, first=0, count=None, batch=1 << 16):
+    """
+    Generates each term of term_generator() independently with probability prob_choose, in the same order.
+    The number of chosen terms is drawn from the binomial distribution and their ranks are sampled directly,
+    the cost depends on the number of chosen terms only.
+    :param deg:
+    :param maxelem:
+    :param prob_choose: probability the given element will be chosen
+    :param first: rank of the first term to sample from
+    :param count: number of terms to sample from, all from the first one if None
+    :param batch: number of ranks unranked at once
+    :return:
+    """
+    if deg - 1 > maxelem:
+        raise ValueError('deg too big for the maxelem')
+
+    n = maxelem + 1
+    total = comb_cached(n, deg) - first if count is None else count
+    # drawn from the random module state only, seeding random reproduces the sample
+    rng = np.random.RandomState(random.getrandbits(32))
+    num = int(rng.binomial(total, prob_choose)) if total > 0 else 0
+    ranks = sample_ranks(total, num)
+
+    table = binomial_table(n, deg)
+    for offset in xrange(0, num, batch):
+        chunk = np.array([first + x for x in ranks[offset:offset + batch]], dtype=table.dtype)
+        for term in unrank_terms(chunk, n, deg, table):
+            yield [int(x) for x in term]
+
+
+ALL_ONES64 = np.uint64(0xffffffffffffffff)
+
+# Truth tables of the variables x0..x5 within a 64 bit word, bit j is the bit i of j
+TRUTH_TABLE_WORDS = [np.uint64(sum(1 << j for j in range(64) if (j >> i) & 1)) for i in range(6)]
+
+
+def term_matrix(deg, blocklen, dtype=np.uint16):
+    """
+    Generates all terms of the given degree as a matrix, one term per row, in the term_generator() order.
+    :param deg:
+    :param blocklen:
+    :param dtype:
+    :return: matrix (C(blocklen, deg), deg)
+    """
+    if deg == 0 or deg > blocklen:
+        return np.zeros((1 if deg == 0 else 0, deg), dtype=dtype)
+
+    res = np.arange(blocklen - deg + 1, dtype=np.int64).reshape(-1, 1)
+    for col in range(1, deg):
+        # extend each row with all admissible values of the next variable: last+1 .. blocklen-deg+col
+        last = res[:, -1]
+        counts = blocklen - deg + col - last
+        starts = np.cumsum(counts) - counts
+        nxt = np.repeat(last + 1 - starts, counts) + np.arange(int(counts.sum()), dtype=np.int64)
+        res = np.column_stack((np.repeat(res, counts, axis=0), nxt))
+    return res.astype(dtype)
+
+
 @lru_cache(maxsize=1024)
 def comb(n, k, exact=False):
     return scipy.misc.comb(n, k, exact=exact)
@@ -152,6 +257,18 @@ def zscore_den(observed, expected, N, denom):
     return x / denom
 
 
+def zscores_den(observed, expected, N, denom):
+    """
+    Computes zscores of the numpy array of observations with precomputed denominator, vectorized zscore_den().
+    :param observed: numpy array
+    :param expected:
+    :param N:
+    :param denom:
+    :return: float64 numpy array
+    """
+    return (observed.astype(np.float64) - expected) / float(N) / denom
+
+
 def zscore_p(observed, expected, N):
     """
     Computes z-score for the normal distribution
@@ -222,19 +339,203 @@ def clone_bitarray(other, src=None):
     return to_bitarray(other)
 
 
-def build_term_map(deg, blocklen):
+def _popcount_lut16():
+    """
+    Builds popcount lookup table for all 16 bit words
+    :return:
     """
-    Builds term map (degree, index) -> term
+    idx = np.arange(1 << 16, dtype=np.uint32)
+    lut = np.zeros(1 << 16, dtype=np.uint8)
+    for bit in range(16):
+        lut += ((idx >> bit) & 1).astype(np.uint8)
+    return lut
 
-    :param deg:
+
+# Popcount of all 16 bit words, used if numpy does not have bitwise_count()
+POPCOUNT_LUT16 = _popcount_lut16()
+
+
+def block_to_uint8(block):
+    """
+    Returns the input as a numpy uint8 array, without copying if possible.
+    :param block: raw bytes, bitarray, bitstring or numpy array
+    :return:
+    """
+    if isinstance(block, np.ndarray):
+        return block.view(np.uint8).reshape(-1)
+    elif isinstance(block, (bytes, bytearray, basestring)):
+        return np.frombuffer(block, dtype=np.uint8)
+    else:
+        return np.frombuffer(block.tobytes(), dtype=np.uint8)
+
+
+def popcount(arr):
+    """
+    Hamming weight of the packed uint64 numpy array
+    :param arr:
+    :return: int
+    """
+    if NP_BITWISE_COUNT:
+        return int(np.bitwise_count(arr).sum(dtype=np.uint64))
+    return int(POPCOUNT_LUT16[arr.view(np.uint16)].sum(dtype=np.uint64))
+
+
+def popcount_rows(mat):
+    """
+    Hamming weight of each row of the packed 2-D uint64 numpy matrix. Rows have to be C-contiguous.
+    :param mat:
+    :return: uint64 array, one HW per row
+    """
+    if NP_BITWISE_COUNT:
+        return np.bitwise_count(mat).sum(axis=1, dtype=np.uint64)
+    return POPCOUNT_LUT16[mat.view(np.uint16)].sum(axis=1, dtype=np.uint64)
+
+
+def _transpose8x8(x):
+    """
+    Transposes 8x8 bit matrices in place, one matrix per uint64 word.
+    Row i is the i-th most significant byte of the word, column j is the bit 7-j in the row byte.
+    Hacker's Delight, transpose8.
+    :param x: uint64 numpy array
+    :return:
+    """
+    for shift, mask in ((7, 0x00AA00AA00AA00AA), (14, 0x0000CCCC0000CCCC), (28, 0x00000000F0F0F0F0)):
+        t = np.right_shift(x, np.uint64(shift))
+        t ^= x
+        t &= np.uint64(mask)
+        x ^= t
+        t <<= np.uint64(shift)
+        x ^= t
+    return x
+
+
+def _transpose_tiles(groups, out, col_from, col_to, grp_from, grp_to):
+    """
+    Transposes the given range of 8x8 tiles.
+    :param groups: input uint8 matrix (groups, 8 blocks, block bytes)
+    :param out: basis uint8 matrix (blocklen, bytes)
+    :param col_from: first block byte
+    :param col_to: last block byte, exclusive
+    :param grp_from: first group of 8 blocks
+    :param grp_to: last group of 8 blocks, exclusive
+    :return:
+    """
+    # Word per tile, the first block in the most significant byte.
+    tiles = groups[grp_from:grp_to, :, col_from:col_to]
+    if sys.byteorder == 'little':
+        tiles = tiles[:, ::-1, :]
+    words = np.ascontiguousarray(tiles.transpose(2, 0, 1)).view(np.uint64)
+    words = _transpose8x8(words.reshape(col_to - col_from, grp_to - grp_from))
+
+    # The most significant byte of the transposed word now holds the bit 0 of the block byte
+    res = words.view(np.uint8).reshape(col_to - col_from, grp_to - grp_from, 8)
+    if sys.byteorder == 'little':
+        res = res[:, :, ::-1]
+    out[col_from * 8:col_to * 8, grp_from:grp_to] = res.transpose(0, 2, 1).reshape(-1, grp_to - grp_from)
+
+
+def transpose_blocks(data, blocklen, out, threads=None, grp_chunk=1 << 15):
+    """
+    Builds the whole basis from byte aligned blocks in one pass over the data.
+    Input is processed in 8x8 bit tiles (8 blocks x 1 byte), tiles are distributed among threads
+    by block byte ranges and block ranges.
+
+    out[bitpos] holds packed bit bitpos of all blocks, bitarray ordering (first block = MSB of the first byte).
+
+    :param data: uint8 numpy array, whole blocks
+    :param blocklen: block length in bits, multiple of 8
+    :param out: uint8 matrix (blocklen, >= ceil(blocks / 8)) to write result to
+    :param threads: number of threads to use
+    :param grp_chunk: number of 8 block groups transposed in one task
+    :return: out
+    """
+    if blocklen % 8 != 0:
+        raise ValueError('Block length has to be a multiple of 8')
+
+    num_cols = blocklen // 8
+    num_blocks = len(data) // num_cols
+    num_grp = num_blocks // 8
+    groups = data[0:num_grp * 8 * num_cols].reshape(num_grp, 8, num_cols)
+
+    # Last incomplete group is padded with zero blocks
+    if num_blocks % 8 != 0:
+        tail = np.zeros((1, 8, num_cols), dtype=np.uint8)
+        tail[0, 0:num_blocks % 8, :] = data[num_grp * 8 * num_cols:].reshape(-1, num_cols)
+        _transpose_tiles(tail, out[:, num_grp:num_grp + 1], 0, num_cols, 0, 1)
+
+    threads = max(1, threads or 1)
+    col_step = max(1, (num_cols + threads - 1) // threads)
+    tasks = [(groups, out, col, min(num_cols, col + col_step), grp, min(num_grp, grp + grp_chunk))
+             for col in range(0, num_cols, col_step)
+             for grp in range(0, num_grp, grp_chunk)]
+
+    if threads == 1 or len(tasks) <= 1:
+        for task in tasks:
+            _transpose_tiles(*task)
+        return out
+
+    pool = ThreadPool(threads)
+    try:
+        pool.map(lambda task: _transpose_tiles(*task), tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+
+def block_histogram(data, blocklen, chunk=1 << 20):
+    """
+    Histogram of block values, 2^blocklen bins.
+    Bit 0 of the block (MSB of the first byte, bitarray ordering) is the most significant bit of the value.
+    :param data: uint8 numpy array, whole blocks
+    :param blocklen:
+    :param chunk: number of blocks processed at once
+    :return: int64 numpy array
+    """
+    num_blocks = len(data) * 8 // blocklen
+    hist = np.zeros(1 << blocklen, dtype=np.int64)
+
+    for start in range(0, num_blocks, chunk):
+        cnt = min(chunk, num_blocks - start)
+        if blocklen % 8 == 0:
+            rows = data[start * blocklen // 8:(start + cnt) * blocklen // 8].reshape(cnt, blocklen // 8)
+            vals = np.zeros(cnt, dtype=np.int64)
+            for col in range(blocklen // 8):
+                vals <<= 8
+                vals |= rows[:, col]
+        else:
+            byte_from = start * blocklen // 8
+            bits = np.unpackbits(data[byte_from:(start + cnt) * blocklen // 8 + 1])
+            bit_from = start * blocklen - byte_from * 8
+            bits = bits[bit_from:bit_from + cnt * blocklen].reshape(cnt, blocklen)
+            vals = bits.dot(np.int64(1) << np.arange(blocklen - 1, -1, -1, dtype=np.int64))
+        hist += np.bincount(vals, minlength=1 << blocklen)
+    return hist
+
+
+def superset_sums(hist, nbits):
+    """
+    Superset sum (zeta) transform, res[S] = sum_{T superset of S} hist[T]. O(n 2^n).
+    res[mask] is then the number of blocks where all bits in the mask are set = HW of the monomial.
+    :param hist: histogram with 2^nbits bins
+    :param nbits:
+    :return: new int64 numpy array
+    """
+    res = np.array(hist, dtype=np.int64)
+    for bit in range(nbits):
+        view = res.reshape(-1, 2, 1 << bit)
+        view[:, 0, :] += view[:, 1, :]
+    return res
+
+
+def hist_fits(blocklen):
+    """
+    Returns True if the histogram engine can be used for the block length - histogram and its
+    transform fit the available memory.
     :param blocklen:
     :return:
     """
-    term_map = [[0] * comb(blocklen, x, True) for x in range(deg + 1)]
-    for dg in range(1, deg + 1):
-        for idx, x in enumerate(term_generator(dg, blocklen - 1)):
-            term_map[dg][idx] = x
-    return term_map
+    return blocklen <= HIST_MAX_BLOCKLEN and 3 * 8 * (1 << blocklen) < psutil.virtual_memory().available
 
 
 @lru_cache(maxsize=1024)
@@ -253,6 +554,59 @@ def comb_cached(n, k):
     return val
 
 
+def binomial_table(n, k):
+    """
+    Table of binomial numbers, table[x, y] = C(x, y) for x in [0, n], y in [0, k].
+    :param n:
+    :param k:
+    :return: int64 numpy matrix, object matrix if the numbers do not fit int64
+    """
+    rows = [[comb_cached(x, y) for y in range(k + 1)] for x in range(n + 1)]
+    fits = max(max(row) for row in rows) < (1 << 63)
+    return np.array(rows, dtype=np.int64 if fits else object)
+
+
+def rank_terms(terms, n, table=None):
+    """
+    Vectorized rank of terms, inverse to the term_generator() order.
+    rank = C(n, k) - 1 - sum_i C(n - 1 - t_i, k - i)
+    :param terms: matrix (num_terms, k) of sorted variable indices
+    :param n: number of variables
+    :param table: binomial_table(n, >= k), computed if not given
+    :return: int64 numpy array of ranks
+    """
+    terms = np.asarray(terms, dtype=np.int64)
+    k = terms.shape[1]
+    if table is None:
+        table = binomial_table(n, k)
+    res = np.full(terms.shape[0], comb_cached(n, k) - 1, dtype=table.dtype)
+    for i in range(k):
+        res -= table[n - 1 - terms[:, i], k - i]
+    return res
+
+
+def unrank_terms(ranks, n, k, table=None):
+    """
+    Vectorized unrank, inverse to rank_terms().
+    C(n, k) - 1 - rank is decomposed in the combinatorial number system, sum_i C(c_i, k - i), t_i = n - 1 - c_i.
+    :param ranks: array of ranks
+    :param n: number of variables
+    :param k: degree
+    :param table: binomial_table(n, >= k), computed if not given
+    :return: int64 numpy matrix (len(ranks), k)
+    """
+    if table is None:
+        table = binomial_table(n, k)
+    rest = comb_cached(n, k) - 1 - np.asarray(ranks, dtype=table.dtype).reshape(-1)
+    res = np.zeros((len(rest), k), dtype=np.int64)
+    for i in range(k):
+        col = table[:, k - i]
+        cs = np.searchsorted(col, rest, side='right') - 1
+        rest = rest - col[cs]
+        res[:, i] = n - 1 - cs
+    return res
+
+
 @lru_cache(maxsize=1024)
 def unrank(i, n, k):
     """
@@ -527,6 +881,380 @@ class AESInputObject(InputObject):
         return data
 
 
+def poly_canonical(poly):
+    """
+    Canonical form of the polynomial for caching - variables renamed in the order of appearance, terms sorted.
+    Renaming and sorting is repeated while it changes the polynomial.
+    e.g., x7x8x9 + x1x8 -> x0x1 + x1x2x3
+    :param poly:
+    :return: canonical polynomial
+    """
+    res = sorted([sorted(set(x)) for x in poly], key=lambda x: (len(x), x))
+    for _ in range(len(res) + 1):
+        idx_map = {}
+        npoly = [sorted(idx_map.setdefault(y, len(idx_map)) for y in x) for x in res]
+        npoly.sort(key=lambda x: (len(x), x))
+        if npoly == res:
+            break
+        res = npoly
+    return res
+
+
+def poly_key(poly):
+    """
+    String key of the polynomial
+    :param poly:
+    :return:
+    """
+    return ','.join(['-'.join([str(y) for y in x]) for x in poly])
+
+
+class ExppCache(object):
+    """
+    Cache of the expected probabilities / simulation results shared by all term evaluators in the process.
+    In-memory LRU with an optional SQLite backing store shared across runs, writes are file-locked.
+    """
+    def __init__(self, size=4096, path=None, flush_size=256, *args, **kwargs):
+        self.size = size
+        self.path = path
+        self.flush_size = flush_size
+        self.cache = LRUCache(size)
+        self.pending = {}
+        self.conn = None
+        self.conn_pid = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.path is not None:
+            atexit.register(self.flush)
+
+    def __repr__(self):
+        return ('ExppCache(size=%s, path=%r, hits=%d, disk_hits=%d, misses=%d)'
+                % (self.size, self.path, self.hits, self.disk_hits, self.misses))
+
+    def stats(self):
+        """
+        Hit / miss counters
+        :return: (hits, disk_hits, misses)
+        """
+        return self.hits, self.disk_hits, self.misses
+
+    def add_stats(self, stats):
+        """
+        Adds counters of another cache, e.g., the copy in a forked worker
+        :param stats: stats() of the other cache
+        :return:
+        """
+        self.hits += stats[0]
+        self.disk_hits += stats[1]
+        self.misses += stats[2]
+
+    def connect(self):
+        """
+        SQLite connection, reopened in forked processes
+        :return:
+        """
+        if self.conn is None or self.conn_pid != os.getpid():
+            with filelock.FileLock(self.path + '.lock'):
+                self.conn = sqlite3.connect(self.path)
+                self.conn.execute('CREATE TABLE IF NOT EXISTS expp (key TEXT PRIMARY KEY, val REAL)')
+                self.conn.commit()
+            self.conn_pid = os.getpid()
+        return self.conn
+
+    def get(self, key):
+        """
+        Cached value or None
+        :param key:
+        :return:
+        """
+        val = self.cache.get(key)
+        if val is not None:
+            self.hits += 1
+            return val
+
+        if self.path is not None:
+            val = self.pending.get(key)
+            if val is None:
+                row = self.connect().execute('SELECT val FROM expp WHERE key = ?', (key,)).fetchone()
+                val = row[0] if row is not None else None
+            if val is not None:
+                self.disk_hits += 1
+                self.cache.put(key, val)
+                return val
+
+        self.misses += 1
+        return None
+
+    def put(self, key, val):
+        """
+        Stores the value, written to the backing store by flush()
+        :param key:
+        :param val:
+        :return:
+        """
+        self.cache.put(key, val)
+        if self.path is None:
+            return
+
+        self.pending[key] = val
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes pending values to the backing store
+        :return:
+        """
+        if self.path is None or len(self.pending) == 0:
+            return
+
+        conn = self.connect()
+        with filelock.FileLock(self.path + '.lock'):
+            conn.executemany('INSERT OR REPLACE INTO expp (key, val) VALUES (?, ?)', list(self.pending.items()))
+            conn.commit()
+        self.pending = {}
+
+
+def get_expp_cache():
+    """
+    Returns the process-wide expected probability cache, in-memory one is created if not initialized
+    :return: ExppCache
+    """
+    global _EXPP_CACHE
+    if _EXPP_CACHE is None:
+        _EXPP_CACHE = ExppCache()
+    return _EXPP_CACHE
+
+
+def init_expp_cache(size=4096, path=None):
+    """
+    Initializes the process-wide expected probability cache, kept if already configured the same way
+    :param size: number of entries in memory
+    :param path: SQLite file backing the cache, None for the in-memory cache only
+    :return: ExppCache
+    """
+    global _EXPP_CACHE
+    if _EXPP_CACHE is not None and (_EXPP_CACHE.size, _EXPP_CACHE.path) == (size, path):
+        return _EXPP_CACHE
+    if _EXPP_CACHE is not None:
+        _EXPP_CACHE.flush()
+    _EXPP_CACHE = ExppCache(size, path)
+    return _EXPP_CACHE
+
+
+class TermIndex(object):
+    """
+    Compact term index, conversion between ranks and terms of all degrees up to deg.
+    Conversions use the binomial table. Small degrees can be stored as uint16 term matrices
+    (C(n, deg) x deg), built lazily on the first use.
+    """
+    def __init__(self, blocklen, deg, use_matrix=True, max_matrix_size=1 << 26, *args, **kwargs):
+        """
+        :param blocklen: number of variables
+        :param deg: maximal degree
+        :param use_matrix: store term matrices if they fit max_matrix_size
+        :param max_matrix_size: maximal size of one term matrix in bytes
+        """
+        self.blocklen = blocklen
+        self.deg = deg
+        self.use_matrix = use_matrix
+        self.max_matrix_size = max_matrix_size
+        self.binom = binomial_table(blocklen, deg)
+        self.matrices = {}
+
+    def num_terms(self, deg):
+        """
+        Number of terms of the given degree
+        :param deg:
+        :return:
+        """
+        return comb_cached(self.blocklen, deg)
+
+    def get_matrix(self, deg):
+        """
+        Returns term matrix of the given degree or None if disabled / too big
+        :param deg:
+        :return:
+        """
+        if deg in self.matrices:
+            return self.matrices[deg]
+
+        matrix = None
+        if self.use_matrix and self.num_terms(deg) * deg * 2 <= self.max_matrix_size:
+            matrix = term_matrix(deg, self.blocklen, dtype=np.uint16)
+        self.matrices[deg] = matrix
+        return matrix
+
+    def rank_term(self, term):
+        """
+        Rank of a single sorted term, scalar version of rank()
+        :param term:
+        :return: int
+        """
+        k = len(term)
+        res = comb_cached(self.blocklen, k) - 1
+        for i in range(k):
+            res -= comb_cached(self.blocklen - 1 - term[i], k - i)
+        return res
+
+    def rank(self, terms):
+        """
+        Ranks of the terms of the same degree
+        :param terms: matrix (num_terms, deg) or list of terms
+        :return: numpy array of ranks
+        """
+        return rank_terms(terms, self.blocklen, self.binom)
+
+    def unrank(self, deg, ranks):
+        """
+        Terms of the given ranks
+        :param deg:
+        :param ranks: array of ranks
+        :return: numpy matrix (len(ranks), deg)
+        """
+        matrix = self.get_matrix(deg)
+        if matrix is not None:
+            return matrix[np.asarray(ranks, dtype=np.int64)]
+
+        if self.binom.dtype == object:
+            return np.array([unrank(int(x), self.blocklen, deg) for x in ranks], dtype=np.int64).reshape(-1, deg)
+        return unrank_terms(ranks, self.blocklen, deg, self.binom)
+
+    def term(self, deg, rank):
+        """
+        Single term of the given rank
+        :param deg:
+        :param rank:
+        :return: list of variables
+        """
+        return [int(x) for x in self.unrank(deg, [rank])[0]]
+
+    def terms(self, deg, ranks):
+        """
+        Terms of the given ranks as lists
+        :param deg:
+        :param ranks:
+        :return: list of terms
+        """
+        if len(ranks) == 0:
+            return []
+        return [[int(y) for y in x] for x in self.unrank(deg, ranks)]
+
+
+class TopTermsAccumulator(object):
+    """
+    Streaming statistics of term HWs of a single degree.
+    Keeps k terms with the largest |hw - expected| and running sums for the mean z-score and the fail count,
+    so the full HW table does not have to be built. Accumulators can be merged, e.g., from worker processes.
+    """
+    def __init__(self, k, expected, diff_threshold, *args, **kwargs):
+        # number of top terms to keep, negative = all
+        self.k = k
+        self.expected = float(expected)
+        self.diff_threshold = float(diff_threshold)
+
+        self.count = 0
+        self.diff_sum = 0.0
+        self.over = 0
+
+        # current top terms, unsorted
+        self.idx = np.zeros(0, dtype=np.int64)
+        self.hws = np.zeros(0, dtype=np.uint64)
+        self.diffs = np.zeros(0, dtype=np.float64)
+
+        # candidates not yet merged to the top
+        self.pending = []
+        self.pending_len = 0
+
+        # candidates with diff < min_diff cannot enter the full top
+        self.min_diff = -1.0
+
+    def __len__(self):
+        """
+        Number of terms seen
+        :return:
+        """
+        return self.count
+
+    def empty_copy(self):
+        """
+        Returns a new empty accumulator with the same parameters
+        :return:
+        """
+        return TopTermsAccumulator(self.k, self.expected, self.diff_threshold)
+
+    def add(self, offset, hws):
+        """
+        Adds HWs of terms with consecutive ranks
+        :param offset: rank of the first term
+        :param hws: uint64 numpy array of HWs
+        :return:
+        """
+        diffs = np.abs(hws.astype(np.float64) - self.expected)
+        self.count += len(hws)
+        self.diff_sum += float(diffs.sum())
+        self.over += int(np.count_nonzero(diffs >= self.diff_threshold))
+
+        sel = np.flatnonzero(diffs >= self.min_diff)
+        if len(sel) == 0:
+            return
+
+        self.pending.append((sel + offset, hws[sel], diffs[sel]))
+        self.pending_len += len(sel)
+        if self.pending_len >= max(4 * self.k, 1 << 16):
+            self.compact()
+
+    def merge(self, other):
+        """
+        Merges other accumulator to this one
+        :param other:
+        :return:
+        """
+        other.compact()
+        self.count += other.count
+        self.diff_sum += other.diff_sum
+        self.over += other.over
+        self.pending.append((other.idx, other.hws, other.diffs))
+        self.pending_len += len(other.idx)
+        self.compact()
+
+    def compact(self):
+        """
+        Merges pending candidates to the top
+        :return:
+        """
+        if self.pending_len == 0:
+            return
+
+        self.idx = np.concatenate([self.idx] + [x[0] for x in self.pending])
+        self.hws = np.concatenate([self.hws] + [x[1] for x in self.pending])
+        self.diffs = np.concatenate([self.diffs] + [x[2] for x in self.pending])
+        self.pending = []
+        self.pending_len = 0
+
+        if 0 <= self.k < len(self.diffs):
+            # k-th largest diff, ties on the boundary resolved by the (diff, hw, idx) order
+            kth = np.partition(self.diffs, len(self.diffs) - self.k)[len(self.diffs) - self.k] if self.k > 0 else np.inf
+            cand = np.flatnonzero(self.diffs >= kth)
+            sel = cand[np.lexsort((self.idx[cand], self.hws[cand], self.diffs[cand]))[::-1][0:self.k]]
+            self.idx, self.hws, self.diffs = self.idx[sel], self.hws[sel], self.diffs[sel]
+
+        if 0 < self.k <= len(self.diffs):
+            self.min_diff = float(self.diffs.min())
+
+    def top(self):
+        """
+        Returns top terms sorted by (diff, hw, idx), descending
+        :return: (idx, hws, diffs) numpy arrays
+        """
+        self.compact()
+        order = np.lexsort((self.idx, self.hws, self.diffs))[::-1]
+        return self.idx[order], self.hws[order], self.diffs[order]
+
+
 class TermEval(object):
     def __init__(self, blocklen=128, deg=1, *args, **kwargs):
         # block length in bits, term size.
@@ -541,8 +1269,19 @@ class TermEval(object):
         self.cur_evals = None
         self.last_base_size = None
 
-        # caches
-        self.sim_norm_cache = LRUCache(64)
+        # number of threads for the basis construction
+        self.threads = None
+
+        # AND combination prefixes sparser than this are kept as positions of the set bits, None = dense only
+        self.sparse_density = None
+
+        # caches, sim_norm_cache is process-wide and keyed on the canonical polynomial
+        self.sim_norm_cache = get_expp_cache()
+        self.expp_shape_cache = LRUCache(4096)
+        self.expp_rec_cache = LRUCache(1 << 16)
+
+        # polynomials with more variables than this are evaluated recursively instead of simulated
+        self.expp_sim_max_deg = 16
 
     def base_size(self):
         """
@@ -654,6 +1393,18 @@ class TermEval(object):
         else:
             return block.count(True)
 
+    def hw_range(self, block, start, stop):
+        """
+        Computes hamming weight of the block on the samples [start, stop)
+        :param block: bit representation of the input
+        :param start: multiple of 64
+        :param stop: multiple of 64 or the number of samples
+        :return:
+        """
+        if FAST_IMPL:
+            return block.count(True, start, stop)
+        return block[start:stop].count(True)
+
     def term_generator(self, deg=None):
         """
         Returns term generator for given deg (internal if none is given) and blocklen
@@ -692,6 +1443,18 @@ class TermEval(object):
         if self.base is None or self.last_base_size != (self.blocklen, res_size):
             self.base = [None] * self.blocklen
 
+        # Byte aligned blocks - whole basis at once with the single pass transposition
+        if FAST_IMPL and self.blocklen % 8 == 0 and eval_only_vars is None:
+            trans = np.zeros((self.blocklen, (res_size + 7) // 8), dtype=np.uint8)
+            transpose_blocks(block_to_uint8(block), self.blocklen, trans, threads=self.threads)
+            for bitpos in range(0, self.blocklen):
+                self.base[bitpos] = bitarray.bitarray(endian='big')
+                self.base[bitpos].frombytes(trans[bitpos].tobytes())
+                del self.base[bitpos][res_size:]
+
+            self.last_base_size = (self.blocklen, res_size)
+            return
+
         for bitpos in range(0, self.blocklen):
             ctr = 0
             if bitpos != 0 and eval_only_vars is not None and bitpos not in eval_only_vars:
@@ -780,7 +1543,29 @@ class TermEval(object):
         assert ctr == len(hws)
         return hws
 
-    def eval_all_terms(self, deg=None):
+    def new_hws(self, deg, hw=None, skip_top=False):
+        """
+        Returns zeroed HW accumulators hw[deg][rank] of degrees [1, deg], uint64 numpy arrays.
+        :param deg:
+        :param hw: accumulators from the previous call to reuse, if they match
+        :param skip_top: the top degree accumulator is not allocated (streaming), deg > 1
+        :return:
+        """
+        res = [None] * (deg+1)
+        res[0] = []
+        for idx in range(1, deg+1):
+            if skip_top and idx == deg and idx > 1:
+                continue
+
+            num_terms = self.num_terms(idx, False, exact=True)
+            if hw is not None and idx < len(hw) and isinstance(hw[idx], np.ndarray) and len(hw[idx]) == num_terms:
+                res[idx] = hw[idx]
+                res[idx].fill(0)
+            else:
+                res[idx] = np.zeros(num_terms, dtype=np.uint64)
+        return res
+
+    def eval_all_terms(self, deg=None, hw=None):
         """
         Evaluates all terms of deg [1, deg].
 
@@ -798,24 +1583,21 @@ class TermEval(object):
 
         :warning: Works only with fast ph4r05 implementation.
         :param deg:
-        :return:
+        :param hw: accumulators to reuse, see new_hws()
+        :return: hw[deg][rank] of uint64 numpy arrays
         """
         if deg is None:
             deg = self.deg
 
-        hw = [None] * (deg+1)
-        hw[0] = []
-        for idx in range(1, deg+1):
-            hw[idx] = [0] * self.num_terms(idx, False, exact=True)
+        hw = self.new_hws(deg, hw)
 
         # deg1 is simple - just use HW on the basis
-        hw[1] = [x.count() for x in self.base]
+        hw[1][:] = [x.count() for x in self.base]
         if deg <= 1:
             return hw
 
         # deg2 is simple to compute without optimisations, if it is the top order we are interested in.
         if deg == 2:
-            hw[2] = [0] * self.num_terms(2, False, exact=True)
             for idx, term in enumerate(self.term_generator(2)):
                 hw[2][idx] = self.base[term[0]].fast_hw_and(self.base[term[1]])
             return hw
@@ -944,10 +1726,126 @@ class TermEval(object):
             res ^= self.eval_term(poly[i], res=subres)
         return res
 
-    def expp_term_deg(self, deg):
+    def eval_terms_cache(self, terms):
         """
-        Returns expected probability of result=1 of a term with given degree under null hypothesis of uniformity.
-        :param deg:
+        Evaluates each of the terms once, for the repeated use in combine_cached().
+        :param terms: list of terms
+        :return: list of evaluated terms
+        """
+        return [self.eval_term(term) for term in terms]
+
+    def copy_buffer(self, src, res):
+        """
+        Copies src buffer to res
+        :param src:
+        :param res:
+        :return: res
+        """
+        if FAST_IMPL_PH4:
+            res.fast_copy(src)
+        else:
+            res.setall(False)
+            res |= src
+        return res
+
+    def combine_buffers(self, a, b, op_xor=True, res=None):
+        """
+        res = a XOR b, or a AND b
+        :param a:
+        :param b:
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :return: res
+        """
+        if res is None:
+            res = self.new_buffer()
+        self.copy_buffer(a, res)
+        if op_xor:
+            res ^= b
+        else:
+            res &= b
+        return res
+
+    def combine_cached(self, cache, places, op_xor=True, res=None, prev=None, partial=None):
+        """
+        Combines cached term evaluations by XOR or AND.
+
+        If partial buffers are given, partial[i] holds the combination of places[0..i] and is reused
+        while the prefix is the same as in the previous combination, prev. Combinations generated in the
+        lexicographic order then cost a single operation each.
+
+        :param cache: eval_terms_cache() result
+        :param places: indices of the combined terms in the cache
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :param prev: places of the previous combination evaluated with the same partial buffers
+        :param partial: len(places) - 1 buffers, partial[0] is not used
+        :return:
+        """
+        if res is None:
+            res = self.new_buffer()
+
+        ln = len(places)
+        if ln == 1:
+            return self.copy_buffer(cache[places[0]], res)
+
+        if partial is None:
+            self.combine_buffers(cache[places[0]], cache[places[1]], op_xor, res)
+            for idx in range(2, ln):
+                self.combine_buffers(res, cache[places[idx]], op_xor, res)
+            return res
+
+        same = self.shared_prefix(places, prev)
+        for idx in range(max(same, 1), ln - 1):
+            self.combine_buffers(cache[places[0]] if idx == 1 else partial[idx - 1], cache[places[idx]], op_xor,
+                                 partial[idx])
+
+        return self.combine_buffers(cache[places[0]] if ln == 2 else partial[ln - 2], cache[places[-1]], op_xor, res)
+
+    def combine_cached_hw(self, cache, places, op_xor=True, res=None, prev=None, partial=None):
+        """
+        Hamming weight of the combine_cached() result.
+        :param cache: eval_terms_cache() result
+        :param places: indices of the combined terms in the cache
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :param prev: places of the previous combination evaluated with the same partial buffers
+        :param partial: len(places) - 1 buffers, partial[0] is not used
+        :return:
+        """
+        return self.hw(self.combine_cached(cache, places, op_xor, res, prev, partial))
+
+    def combine_cached_sparse(self, cache, places, op_xor=True, res=None, prev=None, partial=None):
+        """
+        combine_cached() result for the HW counting, engines with sparse_density may return AND combinations
+        in their sparse representation. hw() and hw_range() accept both.
+        :param cache: eval_terms_cache() result
+        :param places: indices of the combined terms in the cache
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :param prev: places of the previous combination evaluated with the same partial buffers
+        :param partial: len(places) - 1 buffers, partial[0] is not used
+        :return:
+        """
+        return self.combine_cached(cache, places, op_xor, res, prev, partial)
+
+    def shared_prefix(self, places, prev):
+        """
+        Length of the prefix shared with the previous combination, its partial results are valid
+        :param places:
+        :param prev:
+        :return:
+        """
+        same = 0
+        if prev is not None and len(prev) == len(places):
+            while same < len(places) - 1 and prev[same] == places[same]:
+                same += 1
+        return same
+
+    def expp_term_deg(self, deg):
+        """
+        Returns expected probability of result=1 of a term with given degree under null hypothesis of uniformity.
+        :param deg:
         :return:
         """
         return math.pow(2, -1 * deg)
@@ -1078,11 +1976,8 @@ class TermEval(object):
         :param deg:
         :return: number of polynomial evaluations to 1
         """
-        if self.sim_norm_cache is None:
-            return self.expnum_poly_sim_norm(poly, deg)
-
         # LRU cached sim variant
-        key = ','.join(['-'.join([str(y) for y in x]) for x in poly])
+        key = 'sim:%d:%s' % (deg, poly_key(poly_canonical(poly)))
         val = self.sim_norm_cache.get(key)
         if val is not None:
             return val
@@ -1094,32 +1989,34 @@ class TermEval(object):
     def expnum_poly_sim_norm(self, poly, deg):
         """
         Computes how many times the given polynomial evaluates to 1 for all variable combinations.
+        Bit-parallel truth tables: bit j of the 2^deg bit table is the value for the assignment j,
+        variable x_i is the bit i of j. Terms are ANDs of the variable tables, the polynomial is their XOR.
+        Variables x0..x5 select bits within a word, the term is a constant word.
+        Variables x6.. select whole words, the term word is used where the word index has all their bits set.
         :param poly:
         :param deg:
         :return: number of polynomial evaluations to 1
         """
-        # current evaluation is simple - iterate over all possible values of variables.
-        num_one = 0
-
-        gen = pos_generator(dim=deg, maxelem=1)
-        for val in gen:
-            # val is [x0,x1,x2,x3,x4,...] current variable value vector.
-            # res = current polynomial evaluation
-            res = 0
-
-            # for each term &&-operation
-            for term in poly:
-                cval = 1
-                for idx in term:
-                    if val[idx] == 0:
-                        cval = 0
-                        break
-                res ^= cval
+        num_words = max(1, (1 << deg) // 64)
+        words = np.arange(num_words, dtype=np.uint64)
+        res = np.zeros(num_words, dtype=np.uint64)
+        for term in poly:
+            low, high = ALL_ONES64, 0
+            for idx in set(term):
+                if idx < 6:
+                    low &= TRUTH_TABLE_WORDS[idx]
+                else:
+                    high |= 1 << (idx - 6)
 
-            if res > 0:
-                num_one += 1
+            if high == 0:
+                np.bitwise_xor(res, low, out=res)
+            else:
+                high = np.uint64(high)
+                np.bitwise_xor(res, low, out=res, where=np.bitwise_and(words, high) == high)
 
-        return num_one
+        if deg < 6:
+            res &= np.uint64((1 << (1 << deg)) - 1)
+        return popcount(res)
 
     def expp_poly_dep(self, poly, neg=0):
         """
@@ -1127,7 +2024,7 @@ class TermEval(object):
         It is assumed each term in the polynomial shares at least one variable with a different term
         in the polynomial so it cannot be easily optimised.
         :param poly:
-        :param neg: internal, for recursion
+        :param neg: constant XORed to the polynomial
         :return: probability of polynomial evaluating to 1 over all possibilities of variables
         """
 
@@ -1135,32 +2032,130 @@ class TermEval(object):
         ln = len(poly)
         if ln == 1:
             # only one term - evaluate independently
-            return self.expp_term(poly[0])
+            res = self.expp_term(poly[0])
+            return 1.0 - res if neg else res
 
         # More than 1 term. Remap term for evaluation & degree detection.
         npoly, idx_map_rev = self.poly_remap(poly)
         deg = len(idx_map_rev)
 
         # if degree is small do the all combinations algorithm
-        ones = self.expnum_poly_sim_norm_cached(npoly, deg)
-        return float(ones) / float(2**deg)
-
-        # for long degree or long polynomial we can do this:
-        # a) Isolate independent variables, substitute them with a single one:
-        #  x1x2x3x7x8 + x2x3x4x9x10x11 + x1x4x12x23 can be simplified to
-        #  x1x2x3A    + x2x3x4B        + x1x4C - we don't need to iterate over independent variables
-        #  here (e.g., x7x8x9x10,...). New variables A, B, C aggregate independent variables in the
-        #  original equation. We evaluate A,B,C only one, A is 1 with prob 1/4, B 1/8, C 1/4. This is considered
-        #  during the evaluation.
-        #
-        # b) recursive evaluation with branch pruning.
-        # recursively do:
-        #  - Is polynomial a const? Return.
-        #  - Is polynomial of 1 term only? Return.
-        #  - 1. fix the fist variable x1=0, use poly_fix_var, (some terms drop out), evaluate recursively.
-        #  - 2. fix the fist variable x1=1, use poly_fix_var, evaluate recursively.
-        #  - result = 0.5 * fix0 + 0.5 * fix1
-        #  The pruning on the 0 branches can potentially save a lot of evaluations.
+        if deg <= self.expp_sim_max_deg:
+            ones = self.expnum_poly_sim_norm_cached(npoly, deg)
+            res = float(ones) / float(2**deg)
+            return 1.0 - res if neg else res
+
+        # for long degree or long polynomial the recursive evaluation with branch pruning, cached across runs
+        key = 'rec:%s' % poly_key(poly_canonical(npoly))
+        res = self.sim_norm_cache.get(key)
+        if res is None:
+            res = self.expp_poly_rec(npoly, [1] * deg)
+            self.sim_norm_cache.put(key, res)
+        return 1.0 - res if neg else res
+
+    def expp_poly_rec(self, poly, weights, neg=0):
+        """
+        Recursive evaluation of the expected probability with branch pruning.
+        Variable x_i is 1 with probability 2^-weights[i], initially all weights are 1.
+
+        a) Isolate independent variables, substitute them with a single one:
+           x1x2x3x7x8 + x2x3x4x9x10x11 + x1x4x12x23 is simplified to
+           x1x2x3A    + x2x3x4B        + x1x4C, A is 1 with prob 1/4, B 1/8, C 1/4.
+        b) Independent clusters of terms are evaluated separately and XORed with expp_xor_indep().
+        c) Otherwise the variable present in the most terms is fixed to 0 and 1 using poly_fix_var(),
+           fixing to 0 removes all the terms with the variable.
+           result = (1 - p) * fix0 + p * fix1
+
+        Residual polynomials are memoized in the canonical form - variables remapped in the order of appearance
+        in the sorted terms, with their weights and neg.
+
+        :param poly: list of terms, variables are indices to weights
+        :param weights: weights of the variables
+        :param neg: constant XORed to the polynomial
+        :return: probability of polynomial evaluating to 1
+        """
+        # Terms cancel out in pairs, empty term is constant 1
+        parity = {}
+        for term in poly:
+            key = tuple(sorted(set(term)))
+            parity[key] = parity.get(key, 0) ^ 1
+        terms = sorted(x for x in parity if parity[x])
+        if len(terms) > 0 and len(terms[0]) == 0:
+            neg ^= 1
+            terms = terms[1:]
+        if len(terms) == 0:
+            return float(neg)
+
+        # Variables present in a single term are aggregated to one variable with the sum of weights
+        occurrences = {}
+        for term in terms:
+            for idx in term:
+                occurrences[idx] = occurrences.get(idx, 0) + 1
+
+        weights = list(weights)
+        for tidx, term in enumerate(terms):
+            private = [x for x in term if occurrences[x] == 1]
+            if len(private) > 1:
+                weights[private[0]] = sum(weights[x] for x in private)
+                terms[tidx] = tuple(x for x in term if occurrences[x] > 1 or x == private[0])
+
+        if len(terms) == 1:
+            res = math.pow(2, -sum(weights[x] for x in terms[0]))
+            return 1.0 - res if neg else res
+
+        # Canonical form, memoized
+        npoly, idx_map_rev = self.poly_remap(sorted(terms))
+        nweights = [0] * len(idx_map_rev)
+        for idx, nidx in idx_map_rev.items():
+            nweights[nidx] = weights[idx]
+
+        key = (tuple(tuple(x) for x in npoly), tuple(nweights), neg)
+        val = self.expp_rec_cache.get(key)
+        if val is not None:
+            return val
+
+        clusters = self.poly_clusters(npoly)
+        if len(clusters) > 1:
+            probs = [self.expp_poly_rec(x, nweights) for x in clusters]
+            val = reduce(lambda x, y: self.expp_xor_indep(x, y), probs)
+            val = 1.0 - val if neg else val
+
+        else:
+            # Fixing the most frequent variable prunes the most terms in the 0 branch
+            counts = [0] * len(nweights)
+            for term in npoly:
+                for idx in term:
+                    counts[idx] += 1
+            var = counts.index(max(counts))
+
+            prob = math.pow(2, -nweights[var])
+            poly0, neg0 = self.poly_fix_var(npoly, neg, var, 0)
+            poly1, neg1 = self.poly_fix_var(npoly, neg, var, 1)
+            val = ((1.0 - prob) * self.expp_poly_rec(poly0, nweights, neg0)
+                   + prob * self.expp_poly_rec(poly1, nweights, neg1))
+
+        self.expp_rec_cache.put(key, val)
+        return val
+
+    def poly_clusters(self, poly):
+        """
+        Splits the polynomial to clusters of terms not sharing variables with other clusters.
+        :param poly:
+        :return: list of polynomials
+        """
+        uf = ufh.UnionFind()
+        for idx in range(len(poly)):
+            uf.make_set(idx)
+
+        var_term = {}
+        for idx, term in enumerate(poly):
+            for var in term:
+                if var in var_term:
+                    uf.union(var_term[var], idx)
+                else:
+                    var_term[var] = idx
+
+        return [[poly[y] for y in x] for x in uf.get_set_map().values()]
 
     def expp_poly(self, poly):
         """
@@ -1222,6 +2217,882 @@ class TermEval(object):
         res = reduce(lambda x, y: self.expp_xor_indep(x, y), probs)
         return res
 
+    def expp_poly_shape_cached(self, poly):
+        """
+        expp_poly() memoized by the shape of the polynomial - the variable overlap pattern after poly_remap().
+        The probability does not depend on the variable indices, combinations of top terms share few shapes.
+        :param poly:
+        :return: probability of polynomial evaluating to 1 over all possibilities of variables
+        """
+        npoly, _ = self.poly_remap(poly)
+        key = tuple(tuple(x) for x in npoly)
+        val = self.expp_shape_cache.get(key)
+        if val is None:
+            val = self.expp_poly(npoly)
+            self.expp_shape_cache.put(key, val)
+        return val
+
+    def expp_comb_block(self, terms, places, op_xor=True):
+        """
+        Expected probabilities of XOR or AND combinations of the terms, for a block of combinations at once.
+        AND combination is a single term, 2^-|union of variables|.
+        XOR of pairwise disjoint terms is zipped by expp_xor_indep() column-wise,
+        the rest of the XOR combinations goes through expp_poly_shape_cached().
+        Probabilities are dyadic with small denominators so the results are exactly the same as expp_poly().
+
+        :param terms: list of terms
+        :param places: matrix (num_combinations, k) of indices of the combined terms
+        :param op_xor: XOR if True, AND otherwise
+        :return: float numpy array
+        """
+        places = np.asarray(places, dtype=np.int64).reshape(len(places), -1)
+        members = np.zeros((len(terms), self.blocklen), dtype=np.bool_)
+        for idx, term in enumerate(terms):
+            members[idx, list(term)] = True
+
+        if not op_xor:
+            union = np.logical_or.reduce(members[places], axis=1).sum(axis=1)
+            return np.ldexp(1.0, -union)
+
+        term_deg = members.sum(axis=1)
+        overlaps = np.dot(members.astype(np.int32), members.T.astype(np.int32)) > 0
+        disjoint = np.ones(len(places), dtype=np.bool_)
+        for i in range(places.shape[1]):
+            for j in range(i + 1, places.shape[1]):
+                disjoint &= ~overlaps[places[:, i], places[:, j]]
+
+        probs = np.ldexp(1.0, -term_deg[places])
+        res = probs[:, 0]
+        for i in range(1, places.shape[1]):
+            res = self.expp_xor_indep(res, probs[:, i])
+
+        for idx in np.flatnonzero(~disjoint):
+            res[idx] = self.expp_poly_shape_cached([terms[x] for x in places[idx]])
+        return res
+
+
+class TermEvalNp(TermEval):
+    """
+    Term evaluator with the basis stored in a single contiguous numpy matrix.
+    Row i of the basis holds packed evaluations of the variable x_i on all blocks, 64 blocks per uint64 word.
+    Padding bits of the last word are always zero so they do not contribute to any AND / HW.
+    Does not require the patched bitarray extension.
+    Requires numpy >= 2.0 with native bitwise_count to be competitive, the popcount lookup table fallback
+    is about 8x slower than ph4 (degree 3, 128-bit blocks: 33 s vs 3.9 s). The automatic backend choice
+    keeps ph4 then.
+    """
+    def __init__(self, blocklen=128, deg=1, *args, **kwargs):
+        super(TermEvalNp, self).__init__(blocklen=blocklen, deg=deg, *args, **kwargs)
+        self.base = None
+        self.num_words = 0
+
+        # number of worker processes for eval_all_terms
+        self.workers = None
+
+        # size of the basis tile in bytes for the cache blocked evaluation, None = whole basis at once
+        self.tile_size = None
+
+        # size of the buffer in bytes for the last level of the term enumeration, basis rows ANDed at once
+        self.slab_size = 1 << 24
+
+        # AND combination prefixes sparser than this are kept as positions of the set bits, None = dense only
+        self.sparse_density = 1.0 / 32
+
+    def base_size(self):
+        """
+        Returns base size of the vector - number of evaluated blocks
+        :return:
+        """
+        return self.cur_evals
+
+    def new_buffer(self):
+        """
+        Returns the allocated packed vector of the size of the base row.
+        :return:
+        """
+        return np.zeros(self.num_words, dtype=np.uint64)
+
+    def hw(self, block):
+        """
+        Computes hamming weight of the block
+        :param block: packed numpy vector or bit representation of the input
+        :return:
+        """
+        if isinstance(block, np.ndarray):
+            return popcount(block)
+        if isinstance(block, tuple):
+            return int(np.count_nonzero(self.test_positions(block[2], block)))
+        return super(TermEvalNp, self).hw(block)
+
+    def hw_range(self, block, start, stop):
+        """
+        Computes hamming weight of the block on the samples [start, stop)
+        :param block: packed numpy vector or sparse AND, combine_cached_sparse() result
+        :param start: multiple of 64
+        :param stop: multiple of 64 or the number of samples
+        :return:
+        """
+        if isinstance(block, tuple):  # byte indices are sorted, bytes of a word hold the word samples
+            lo, hi = np.searchsorted(block[0], [8 * (start // 64), 8 * ((stop + 63) // 64)])
+            positions = block[0][lo:hi], block[1][lo:hi]
+            return int(np.count_nonzero(self.test_positions(block[2], positions)))
+        return popcount(block[start // 64:(stop + 63) // 64])
+
+    def gen_base(self, block, eval_only_vars=None, **kwargs):
+        """
+        Generate base for term evaluation from the block.
+        :param block: input data - raw bytes, bitarray or bitstring
+        :param eval_only_vars: if not None, evals only those variables mentioned
+        :return:
+        """
+        data = block_to_uint8(block)
+        ln = len(data) * 8
+        if (ln % self.blocklen) != 0:
+            raise ValueError('Input data not multiple of block length')
+
+        self.cur_tv_size = ln // 8
+        self.cur_evals = ln // self.blocklen
+        res_size = self.cur_evals
+
+        if self.base is None or self.last_base_size != (self.blocklen, res_size):
+            self.num_words = (res_size + 63) // 64
+            self.base = np.zeros((self.blocklen, self.num_words), dtype=np.uint64)
+
+        base8 = self.base.view(np.uint8)
+        num_bytes = (res_size + 7) // 8
+
+        if self.blocklen % 8 == 0 and eval_only_vars is None:
+            transpose_blocks(data, self.blocklen, base8, threads=self.threads)
+
+        elif self.blocklen % 8 == 0:
+            # Byte aligned blocks, bitarray ordering - bit 0 is the MSB of the first byte.
+            rows = data.reshape(res_size, self.blocklen // 8)
+            for bitpos in range(0, self.blocklen):
+                if bitpos != 0 and eval_only_vars is not None and bitpos not in eval_only_vars:
+                    continue
+                col = np.right_shift(rows[:, bitpos >> 3], 7 - (bitpos & 7)) & 1
+                base8[bitpos, 0:num_bytes] = np.packbits(col)
+
+        else:
+            # Blocks are not byte aligned, unpack the input by chunks of 2^16 blocks.
+            chunk = 1 << 16
+            for start in range(0, res_size, chunk):
+                cnt = min(chunk, res_size - start)
+                bits = np.unpackbits(data[start * self.blocklen // 8: (start + cnt) * self.blocklen // 8])
+                packed = np.packbits(bits.reshape(cnt, self.blocklen).T, axis=1)
+                base8[:, start // 8: start // 8 + packed.shape[1]] = packed
+
+        self.last_base_size = (self.blocklen, res_size)
+
+    def eval_term(self, term, res=None):
+        """
+        Evaluates term on the block using the precomputed base.
+        :param term: term represented as an array of bit positions
+        :param res: packed vector buffer to put result to
+        :return: packed vector, each bit represents single term evaluation on the given sub-block
+        """
+        if res is None:
+            res = self.new_buffer()
+
+        np.copyto(res, self.base[term[0]])
+        for i in range(1, len(term)):
+            np.bitwise_and(res, self.base[term[i]], out=res)
+        return res
+
+    def eval_terms(self, deg=None):
+        """
+        Evaluates all terms on the input data precomputed in the base.
+        Returns array of hamming weights.
+        :param deg: degree of the terms to generate. If none, default degree is taken.
+        :return: array of hamming weights. idx = 0 -> HW for term with index 0 evaluated on input data.
+        """
+        if deg is None:
+            deg = self.deg
+        return self.eval_all_terms(deg)[deg]
+
+    def eval_terms_cache(self, terms):
+        """
+        Evaluates each of the terms once to a row of a contiguous matrix, for the repeated use in combine_cached().
+        :param terms: list of terms
+        :return: uint64 matrix (len(terms), num_words)
+        """
+        cache = np.empty((len(terms), self.num_words), dtype=np.uint64)
+        for idx, term in enumerate(terms):
+            self.eval_term(term, res=cache[idx])
+        return cache
+
+    def copy_buffer(self, src, res):
+        """
+        Copies src buffer to res
+        :param src:
+        :param res:
+        :return: res
+        """
+        np.copyto(res, src)
+        return res
+
+    def combine_buffers(self, a, b, op_xor=True, res=None):
+        """
+        res = a XOR b, or a AND b, single pass
+        :param a:
+        :param b:
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :return: res
+        """
+        if res is None:
+            res = self.new_buffer()
+        if op_xor:
+            return np.bitwise_xor(a, b, out=res)
+        return np.bitwise_and(a, b, out=res)
+
+    def to_positions(self, buf):
+        """
+        Sparse representation of the packed vector, set bits as (byte indices, bit masks) in the byte view
+        :param buf:
+        :return: (intp numpy array, uint8 numpy array)
+        """
+        buf8 = buf.view(np.uint8)
+        idx = np.flatnonzero(buf8)
+        bits = np.unpackbits(buf8[idx]).reshape(-1, 8)
+        rows, cols = np.nonzero(bits)
+        return idx[rows], np.left_shift(np.uint8(1), (7 - cols).astype(np.uint8))
+
+    def test_positions(self, buf, positions):
+        """
+        Bits of the packed vector at the given positions
+        :param buf: packed vector
+        :param positions: to_positions() result
+        :return: uint8 numpy array, nonzero where the bit is set
+        """
+        return np.bitwise_and(buf.view(np.uint8)[positions[0]], positions[1])
+
+    def and_sparse(self, a, b, res=None):
+        """
+        a AND b, a is a packed vector or positions, b is a packed vector.
+        Dense result is converted to positions if sparser than sparse_density.
+        :param a:
+        :param b:
+        :param res: dense buffer to put the result to, if a is dense
+        :return: packed vector or positions
+        """
+        if isinstance(a, tuple):
+            sel = self.test_positions(b, a).view(np.bool_)
+            return a[0][sel], a[1][sel]
+
+        res = np.bitwise_and(a, b, out=res if isinstance(res, np.ndarray) else None)
+        if popcount(res) < self.sparse_density * self.cur_evals:
+            return self.to_positions(res)
+        return res
+
+    def combine_cached_hw(self, cache, places, op_xor=True, res=None, prev=None, partial=None):
+        """
+        Hamming weight of the combine_cached() result.
+        AND prefixes switch to the sparse representation once they are sparse enough, extending them
+        then costs a gather of the set positions instead of the full length AND.
+        :param cache: eval_terms_cache() result
+        :param places: indices of the combined terms in the cache
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :param prev: places of the previous combination evaluated with the same partial buffers
+        :param partial: len(places) - 1 buffers, partial[0] is not used. AND replaces sparse ones by positions
+        :return:
+        """
+        return self.hw(self.combine_cached_sparse(cache, places, op_xor, res, prev, partial))
+
+    def combine_cached_sparse(self, cache, places, op_xor=True, res=None, prev=None, partial=None):
+        """
+        combine_cached() result for the HW counting.
+        AND with a sparse prefix is returned as (byte indices, bit masks, last term) - positions of the prefix
+        not yet tested in the last term, hw() and hw_range() gather only the positions they count.
+        :param cache: eval_terms_cache() result
+        :param places: indices of the combined terms in the cache
+        :param op_xor: XOR if True, AND otherwise
+        :param res: buffer to put result to
+        :param prev: places of the previous combination evaluated with the same partial buffers
+        :param partial: len(places) - 1 buffers, partial[0] is not used. AND replaces sparse ones by positions
+        :return: packed vector or (byte indices, bit masks, packed vector)
+        """
+        ln = len(places)
+        if op_xor or partial is None or self.sparse_density is None or ln == 1:
+            return self.combine_cached(cache, places, op_xor, res, prev, partial)
+
+        same = self.shared_prefix(places, prev)
+        for idx in range(max(same, 1), ln - 1):
+            partial[idx] = self.and_sparse(cache[places[0]] if idx == 1 else partial[idx - 1], cache[places[idx]],
+                                           partial[idx])
+
+        last = cache[places[0]] if ln == 2 else partial[ln - 2]
+        if isinstance(last, tuple):
+            return last[0], last[1], cache[places[-1]]
+        return np.bitwise_and(last, cache[places[-1]], out=res)
+
+    def lead_offset(self, lead, deg):
+        """
+        Returns rank of the first term of degree deg with the lowest variable equal to lead.
+        Number of terms with a lower leading variable: C(n, deg) - C(n - lead, deg).
+        :param lead:
+        :param deg:
+        :return:
+        """
+        return comb_cached(self.blocklen, deg) - comb_cached(self.blocklen - lead, deg)
+
+    def eval_all_terms(self, deg=None, sink=None, hw=None):
+        """
+        Evaluates all terms of deg [1, deg].
+        :param deg:
+        :param sink: TopTermsAccumulator - if given, HWs of the top degree are streamed to it, table is not built
+        :param hw: accumulators to reuse, see new_hws()
+        :return: hw[deg][rank] of uint64 numpy arrays, hw[deg] is the sink in the streaming mode
+        """
+        if deg is None:
+            deg = self.deg
+
+        hw = self.new_hws(deg, hw, skip_top=sink is not None)
+        hw[1][:] = popcount_rows(self.base)
+        if deg <= 1:
+            if sink is not None:
+                sink.add(0, hw[1])
+                hw[1] = sink
+            return hw
+
+        if self.workers is not None and self.workers > 1:
+            self.eval_leads_parallel(deg, hw, sink=sink)
+        else:
+            self.eval_leads(self.base, range(self.blocklen), deg, hw, sink=sink)
+
+        if sink is not None:
+            hw[deg] = sink
+        return hw
+
+    def tile_words(self, base):
+        """
+        Returns number of words of one basis tile so the whole tile fits tile_size.
+        :param base:
+        :return:
+        """
+        if self.tile_size is None or self.tile_size <= 0:
+            return base.shape[1]
+        return max(1, min(base.shape[1], self.tile_size // (8 * base.shape[0])))
+
+    def iter_tiles(self, base):
+        """
+        Generates contiguous basis tiles of tile_words() words, the whole basis if tiling is disabled.
+        :param base:
+        :return:
+        """
+        words = self.tile_words(base)
+        if words >= base.shape[1]:
+            yield base
+            return
+
+        for tile_from in range(0, base.shape[1], words):
+            yield np.ascontiguousarray(base[:, tile_from:tile_from + words])
+
+    def lead_counters(self, lead, deg, lead_local=False):
+        """
+        Returns initial rank counters for the subtree of the leading variable.
+        :param lead:
+        :param deg:
+        :param lead_local: if True, ranks are relative to the first term with the lead
+        :return:
+        """
+        if lead_local:
+            return [0] * (deg+1)
+        return [0, 0] + [self.lead_offset(lead, x) for x in range(2, deg+1)]
+
+    def eval_leads(self, base, leads, deg, hw, lead_local=False, sink=None):
+        """
+        Evaluates all terms of degrees [2, deg] with the lowest variable in leads, adds HWs to hw.
+
+        Terms are enumerated depth first, AND of the term prefix is cached for each depth.
+        Pre-order traversal visits terms of each degree in the rank order so the HWs are written
+        to consecutive positions starting at lead_offset().
+
+        If tile_size is set, the samples are split to tiles which fit the cache, whole enumeration
+        runs on each tile and HWs are accumulated.
+
+        :param base: basis matrix
+        :param leads: leading variables to evaluate
+        :param deg:
+        :param hw: hw[deg][rank] accumulator
+        :param lead_local: if True, hw holds only terms of the single lead, ranks start at 0
+        :param sink: TopTermsAccumulator for the top degree HWs, hw[deg] is not used then
+        :return:
+        """
+        if sink is None:
+            for tile in self.iter_tiles(base):
+                bufs = self.alloc_bufs(tile.shape[1], deg)
+                for lead in leads:
+                    ctr = self.lead_counters(lead, deg, lead_local)
+                    self._eval_subtree(tile, tile[lead], lead, 1, deg, hw, ctr, bufs)
+            return
+
+        # Streaming - top degree HWs of a single lead are accumulated over all tiles, then pushed to the sink.
+        for lead in leads:
+            lead_hw = hw[0:deg] + [np.zeros(comb_cached(self.blocklen - 1 - lead, deg - 1), dtype=np.uint64)]
+            for tile in self.iter_tiles(base):
+                bufs = self.alloc_bufs(tile.shape[1], deg)
+                ctr = self.lead_counters(lead, deg, lead_local)
+                ctr[deg] = 0
+                self._eval_subtree(tile, tile[lead], lead, 1, deg, lead_hw, ctr, bufs)
+            sink.add(self.lead_offset(lead, deg), lead_hw[deg])
+
+    def eval_leads_parallel(self, deg, hw, sink=None):
+        """
+        Evaluates all terms of degrees [2, deg] in worker processes, one task per leading variable.
+        Workers are forked after the basis is computed so they share it copy-on-write.
+        Each worker returns HWs of all terms with the given leading variable, these form a contiguous
+        slice of hw[deg] in the rank order.
+
+        :param deg:
+        :param hw: hw[deg][rank] accumulator
+        :param sink: TopTermsAccumulator for the top degree HWs, each worker streams to its own, merged here
+        :return:
+        """
+        global _FORK_TERM_EVAL
+        _FORK_TERM_EVAL = self
+
+        ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        pool = ctx.Pool(self.workers)
+        try:
+            tasks = [(lead, deg, None if sink is None else sink.empty_copy()) for lead in range(self.blocklen - 1)]
+            for lead, lead_hw in pool.imap_unordered(_eval_lead_worker, tasks, chunksize=1):
+                for dg in range(2, deg+1):
+                    if sink is not None and dg == deg:
+                        sink.merge(lead_hw[dg])
+                        continue
+                    offset = self.lead_offset(lead, dg)
+                    hw[dg][offset:offset + len(lead_hw[dg])] += lead_hw[dg]
+        finally:
+            pool.close()
+            pool.join()
+            _FORK_TERM_EVAL = None
+
+    def alloc_bufs(self, words, deg):
+        """
+        Allocates buffers for the term enumeration, one per depth.
+        The last one is a matrix of basis rows for the prefix broadcast at the last level.
+        :param words: number of words of the basis rows
+        :param deg:
+        :return:
+        """
+        rows = max(1, min(self.blocklen, self.slab_size // (8 * words)))
+        return [np.empty(words, dtype=np.uint64) for _ in range(deg - 1)] + \
+               [np.empty((rows, words), dtype=np.uint64)]
+
+    def _eval_slab(self, base, prefix, var_from, hw, slab):
+        """
+        Evaluates prefix * x_var for all var >= var_from, one vectorized AND and popcount per slab of rows.
+        Terms are consecutive in the rank order.
+        :param base: basis matrix
+        :param prefix: evaluated prefix term
+        :param var_from: first variable
+        :param hw: HW accumulator slice for the terms, len = blocklen - var_from
+        :param slab: buffer matrix
+        :return:
+        """
+        rows = slab.shape[0]
+        for row_from in range(var_from, self.blocklen, rows):
+            cnt = min(rows, self.blocklen - row_from)
+            np.bitwise_and(base[row_from:row_from + cnt], prefix, out=slab[:cnt])
+            hw[row_from - var_from:row_from - var_from + cnt] += popcount_rows(slab[:cnt])
+
+    def _eval_subtree(self, base, prefix, last, depth, deg, hw, ctr, bufs):
+        """
+        Evaluates all terms extending the prefix term.
+        At the last level the prefix is broadcast against all remaining basis rows at once.
+        :param base: basis matrix
+        :param prefix: evaluated prefix term of degree depth
+        :param last: highest variable in the prefix
+        :param depth: degree of the prefix
+        :param deg: maximal degree
+        :param hw: hw[deg][rank] accumulator
+        :param ctr: current rank for each degree
+        :param bufs: prefix buffers, one per depth, alloc_bufs()
+        :return:
+        """
+        tmp = bufs[depth]
+        dg = depth + 1
+        if dg == deg:
+            cnt = self.blocklen - last - 1
+            self._eval_slab(base, prefix, last + 1, hw[dg][ctr[dg]:ctr[dg] + cnt], tmp)
+            ctr[dg] += cnt
+            return
+
+        for var in range(last + 1, self.blocklen):
+            np.bitwise_and(prefix, base[var], out=tmp)
+            hw[dg][ctr[dg]] += np.uint64(popcount(tmp))
+            ctr[dg] += 1
+            self._eval_subtree(base, tmp, var, dg, deg, hw, ctr, bufs)
+
+
+def _eval_lead_worker(task):
+    """
+    Worker process - evaluates all terms with the given leading variable on the forked term evaluator.
+    :param task: (lead, deg, sink)
+    :return: (lead, hw), hw[deg] contains HWs of the lead terms in the rank order or the sink with them
+    """
+    lead, deg, sink = task
+    term_eval = _FORK_TERM_EVAL
+    base = term_eval.base
+
+    hw = [None, None] + [np.zeros(comb_cached(term_eval.blocklen - 1 - lead, x - 1), dtype=np.uint64)
+                         for x in range(2, deg+1)]
+    term_eval.eval_leads(base, [lead], deg, hw, lead_local=True)
+    if sink is not None:
+        sink.add(term_eval.lead_offset(lead, deg), hw[deg])
+        hw[deg] = sink
+    return lead, hw
+
+
+class TermEvalHist(TermEvalNp):
+    """
+    Term evaluator for short blocks.
+    HWs of all monomials are derived from the histogram of block values by the superset sum transform,
+    O(n 2^n) regardless of the number of terms, so all degrees up to blocklen are cheap.
+    The packed basis is still computed for the polynomial evaluation (input polynomials, combinations).
+    """
+    def __init__(self, blocklen=128, deg=1, *args, **kwargs):
+        super(TermEvalHist, self).__init__(blocklen=blocklen, deg=deg, *args, **kwargs)
+        if blocklen > HIST_MAX_BLOCKLEN:
+            raise ValueError('Block length %d too big for the histogram engine' % blocklen)
+
+        self.hist = None
+        self.term_masks = {}
+
+    def gen_base(self, block, eval_only_vars=None, **kwargs):
+        """
+        Generate base and the block histogram.
+        :param block: input data - raw bytes, bitarray or bitstring
+        :param eval_only_vars: if not None, evals only those variables mentioned
+        :return:
+        """
+        super(TermEvalHist, self).gen_base(block, eval_only_vars=eval_only_vars, **kwargs)
+        self.hist = block_histogram(block_to_uint8(block), self.blocklen)
+
+    def get_term_masks(self, deg):
+        """
+        Returns histogram indices of all terms of the given degree in the rank order.
+        :param deg:
+        :return:
+        """
+        if deg not in self.term_masks:
+            terms = term_matrix(deg, self.blocklen, dtype=np.int64)
+            self.term_masks[deg] = (np.int64(1) << (self.blocklen - 1 - terms)).sum(axis=1)
+        return self.term_masks[deg]
+
+    def eval_all_terms(self, deg=None, sink=None, hw=None):
+        """
+        Evaluates all terms of deg [1, deg] from the histogram.
+        :param deg:
+        :param sink: TopTermsAccumulator for the top degree HWs
+        :param hw: accumulators to reuse, see new_hws()
+        :return: hw[deg][rank] of uint64 numpy arrays, hw[deg] is the sink in the streaming mode
+        """
+        if deg is None:
+            deg = self.deg
+
+        sums = superset_sums(self.hist, self.blocklen)
+        hw = self.new_hws(deg, hw)
+        for idx in range(1, deg+1):
+            hw[idx][:] = sums[self.get_term_masks(idx)]
+
+        if sink is not None:
+            sink.add(0, hw[deg])
+            hw[deg] = sink
+        return hw
+
+
+class TermEvalGram(TermEvalNp):
+    """
+    Term evaluator computing degree 2 and 3 HWs by matrix products.
+    With X the (blocklen, samples) 0/1 matrix, HW of x_i*x_j is (X X^T)[i, j] and
+    HW of x_i*x_j*x_k is ((X[i+1:] * X[i]) X[i+1:]^T)[j, k], so the optimized BLAS does the work.
+    Samples are processed by chunks of float32 matrices, chunk has at most 2^24 samples so the counts are exact.
+    Higher degrees are evaluated on the basis by the numpy engine.
+
+    Faster than ph4 only for small chunks, where the per-term calls of ph4 dominate. Measured on degree 3,
+    Gram wins below about 5000 samples per chunk: with 2500 samples 0.30 s vs 0.44 s (128-bit blocks) and
+    1.9 s vs 4.7 s (256-bit). With 10000+ samples ph4 is 1.6-5x faster, on degree 2 always 2-4x faster.
+    Faster than the numpy engine without native bitwise_count on degree 2. Never chosen automatically.
+    """
+    # Maximal number of samples in one chunk - float32 represents integers up to 2^24 exactly
+    MAX_CHUNK_SAMPLES = 1 << 24
+
+    def __init__(self, blocklen=128, deg=1, *args, **kwargs):
+        super(TermEvalGram, self).__init__(blocklen=blocklen, deg=deg, *args, **kwargs)
+
+        # memory budget for one unpacked chunk in bytes, tile_size takes precedence if set
+        self.chunk_size = 1 << 26
+
+    def chunk_words(self):
+        """
+        Returns number of basis words unpacked to one float32 chunk.
+        :return:
+        """
+        budget = self.tile_size if self.tile_size is not None and self.tile_size > 0 else self.chunk_size
+        words = max(1, budget // (4 * 64 * self.blocklen))
+        return int(min(words, self.MAX_CHUNK_SAMPLES // 64, self.num_words))
+
+    def iter_chunks(self):
+        """
+        Generates (blocklen, 64*words) float32 0/1 matrices of the basis chunks.
+        Padding bits are zero so they do not contribute.
+        :return:
+        """
+        words = self.chunk_words()
+        base8 = self.base.view(np.uint8)
+        for word_from in range(0, self.num_words, words):
+            bits = np.unpackbits(base8[:, word_from * 8:(word_from + words) * 8], axis=1)
+            yield bits.astype(np.float32)
+
+    def eval_all_terms(self, deg=None, sink=None, hw=None):
+        """
+        Evaluates all terms of deg [1, deg]. Degrees 2 and 3 by matrix products, higher degrees
+        by the numpy engine.
+        :param deg:
+        :param sink: TopTermsAccumulator for the top degree HWs
+        :param hw: accumulators to reuse, see new_hws()
+        :return: hw[deg][rank] of uint64 numpy arrays, hw[deg] is the sink in the streaming mode
+        """
+        if deg is None:
+            deg = self.deg
+        if deg > 3 or deg < 2:
+            return super(TermEvalGram, self).eval_all_terms(deg, sink=sink, hw=hw)
+
+        n = self.blocklen
+        stream = sink is not None and deg == 3
+        hw = self.new_hws(deg, hw, skip_top=stream)
+        hw[1][:] = popcount_rows(self.base)
+
+        # Upper triangle in the row major order = terms in the rank order
+        tri2 = np.triu_indices(n, 1)
+        for xs in self.iter_chunks():
+            hw[2] += np.dot(xs, xs.T)[tri2].astype(np.uint64)
+            if deg == 3 and not stream:
+                for i in range(n - 2):
+                    cur = self._lead_gram(xs, i)
+                    offset = self.lead_offset(i, 3)
+                    hw[3][offset:offset + len(cur)] += cur
+
+        # Streaming - leading variable in the outer loop so only HWs of a single lead are held
+        if stream:
+            for i in range(n - 2):
+                cur = np.zeros(comb_cached(n - 1 - i, 2), dtype=np.uint64)
+                for xs in self.iter_chunks():
+                    cur += self._lead_gram(xs, i)
+                sink.add(self.lead_offset(i, 3), cur)
+
+        elif sink is not None:
+            sink.add(0, hw[deg])
+        if sink is not None:
+            hw[deg] = sink
+        return hw
+
+    def _lead_gram(self, xs, lead):
+        """
+        HWs of all degree 3 terms with the given leading variable on the chunk, in the rank order.
+        :param xs: chunk matrix
+        :param lead:
+        :return:
+        """
+        rest = xs[lead+1:]
+        gram = np.dot(rest * xs[lead], rest.T)
+        return gram[np.triu_indices(len(rest), 1)].astype(np.uint64)
+
+
+class TermEvalBytePair(TermEvalNp):
+    """
+    Term evaluator using joint histograms of byte pairs.
+    Superset sums of the 2^16 histogram of bytes (a, b) give HWs of all terms with variables
+    only in the bytes a and b, for all degrees at once. Degree 2 terms are covered completely,
+    the remaining terms of higher degrees are evaluated on the basis, skipping the covered ones.
+    Requires byte aligned blocks.
+    """
+    def __init__(self, blocklen=128, deg=1, *args, **kwargs):
+        super(TermEvalBytePair, self).__init__(blocklen=blocklen, deg=deg, *args, **kwargs)
+        if blocklen % 8 != 0:
+            raise ValueError('Byte pair engine requires byte aligned blocks')
+
+        self.num_bytes = blocklen // 8
+        self.rows = None
+
+        # deg -> (local masks, [ranks for each byte / byte pair])
+        self.single_cover = {}
+        self.pair_cover = {}
+
+    def gen_base(self, block, eval_only_vars=None, **kwargs):
+        """
+        Generate base, keeps the input bytes for the histograms.
+        :param block: input data - raw bytes, bitarray or bitstring
+        :param eval_only_vars: if not None, evals only those variables mentioned
+        :return:
+        """
+        super(TermEvalBytePair, self).gen_base(block, eval_only_vars=eval_only_vars, **kwargs)
+        self.rows = block_to_uint8(block).reshape(self.cur_evals, self.num_bytes)
+
+    def byte_pairs(self):
+        """
+        Generates all byte pairs a < b
+        :return:
+        """
+        for a in range(self.num_bytes):
+            for b in range(a + 1, self.num_bytes):
+                yield a, b
+
+    def get_single_cover(self, deg):
+        """
+        Terms with all variables in a single byte.
+        :param deg:
+        :return: (histogram masks, list of ranks for each byte)
+        """
+        if deg not in self.single_cover:
+            local = term_matrix(deg, 8, dtype=np.int64)
+            masks = (np.int64(1) << (7 - local)).sum(axis=1)
+            table = binomial_table(self.blocklen, deg)
+            ranks = [rank_terms(local + 8 * a, self.blocklen, table) for a in range(self.num_bytes)]
+            self.single_cover[deg] = masks, ranks
+        return self.single_cover[deg]
+
+    def get_pair_cover(self, deg):
+        """
+        Terms with variables in both bytes of a pair and nowhere else.
+        Local variable 0..7 is in the first byte, 8..15 in the second one.
+        :param deg:
+        :return: (histogram masks, list of ranks for each byte pair in the byte_pairs() order)
+        """
+        if deg not in self.pair_cover:
+            local = term_matrix(deg, 16, dtype=np.int64)
+            local = local[(local[:, 0] < 8) & (local[:, -1] >= 8)]
+            masks = (np.int64(1) << (15 - local)).sum(axis=1)
+            second = local >= 8
+            table = binomial_table(self.blocklen, deg)
+            ranks = [rank_terms(local + np.where(second, 8 * b - 8, 8 * a), self.blocklen, table)
+                     for a, b in self.byte_pairs()]
+            self.pair_cover[deg] = masks, ranks
+        return self.pair_cover[deg]
+
+    def eval_covered(self, deg, hw):
+        """
+        Sets HWs of all terms of degrees [2, deg] with variables in at most two bytes from the histograms.
+        :param deg:
+        :param hw: hw[deg][rank]
+        :return:
+        """
+        for a in range(self.num_bytes):
+            sums = superset_sums(np.bincount(self.rows[:, a], minlength=1 << 8), 8)
+            for dg in range(2, min(deg, 8) + 1):
+                masks, ranks = self.get_single_cover(dg)
+                hw[dg][ranks[a]] = sums[masks]
+
+        for pair_idx, (a, b) in enumerate(self.byte_pairs()):
+            vals = np.left_shift(self.rows[:, a].astype(np.int64), 8) | self.rows[:, b]
+            sums = superset_sums(np.bincount(vals, minlength=1 << 16), 16)
+            for dg in range(2, min(deg, 16) + 1):
+                masks, ranks = self.get_pair_cover(dg)
+                hw[dg][ranks[pair_idx]] = sums[masks]
+
+    def eval_all_terms(self, deg=None, sink=None, hw=None):
+        """
+        Evaluates all terms of deg [1, deg].
+        Covered terms are set from the histograms, the rest is added by the basis enumeration.
+        :param deg:
+        :param sink: TopTermsAccumulator for the top degree HWs, the whole table is computed first
+        :param hw: accumulators to reuse, see new_hws()
+        :return: hw[deg][rank] of uint64 numpy arrays, hw[deg] is the sink in the streaming mode
+        """
+        if deg is None:
+            deg = self.deg
+        if deg <= 1:
+            return super(TermEvalBytePair, self).eval_all_terms(deg, sink=sink, hw=hw)
+
+        hw = self.new_hws(deg, hw)
+        hw[1][:] = popcount_rows(self.base)
+
+        self.eval_covered(deg, hw)
+        if deg > 2 and self.num_bytes > 2:
+            if self.workers is not None and self.workers > 1:
+                self.eval_leads_parallel(deg, hw)
+            else:
+                self.eval_leads(self.base, range(self.blocklen), deg, hw)
+
+        if sink is not None:
+            sink.add(0, hw[deg])
+            hw[deg] = sink
+        return hw
+
+    def _eval_subtree(self, base, prefix, last, depth, deg, hw, ctr, bufs, prefix_bytes=None):
+        """
+        Evaluates all terms extending the prefix term not covered by the byte pair histograms.
+        :param base: basis matrix
+        :param prefix: evaluated prefix term of degree depth
+        :param last: highest variable in the prefix
+        :param depth: degree of the prefix
+        :param deg: maximal degree
+        :param hw: hw[deg][rank] accumulator
+        :param ctr: current rank for each degree
+        :param bufs: prefix buffers, one per depth
+        :param prefix_bytes: sorted tuple of bytes with a prefix variable
+        :return:
+        """
+        if prefix_bytes is None:
+            prefix_bytes = (last >> 3,)
+
+        tmp = bufs[depth]
+        dg = depth + 1
+        if dg == deg:
+            # Only extensions by a variable from a third byte are not covered
+            start = last + 1
+            if len(prefix_bytes) <= 2:
+                start = self.blocklen if len(prefix_bytes) == 1 else 8 * (prefix_bytes[-1] + 1)
+            skip = start - last - 1
+            cnt = self.blocklen - start
+            self._eval_slab(base, prefix, start, hw[dg][ctr[dg] + skip:ctr[dg] + skip + cnt], tmp)
+            ctr[dg] += skip + cnt
+            return
+
+        for var in range(last + 1, self.blocklen):
+            np.bitwise_and(prefix, base[var], out=tmp)
+            var_bytes = prefix_bytes if (var >> 3) == prefix_bytes[-1] else prefix_bytes + (var >> 3,)
+            if len(var_bytes) > 2:
+                hw[dg][ctr[dg]] += np.uint64(popcount(tmp))
+            ctr[dg] += 1
+            self._eval_subtree(base, tmp, var, dg, deg, hw, ctr, bufs, var_bytes)
+
+
+# Available term evaluation backends
+TERM_EVAL_BACKENDS = {
+    'ph4': TermEval,
+    'numpy': TermEvalNp,
+    'hist': TermEvalHist,
+    'gram': TermEvalGram,
+    'bytepair': TermEvalBytePair,
+}
+
+
+def get_term_eval(backend=None, blocklen=128, deg=1, **kwargs):
+    """
+    Creates term evaluator with the given basis backend.
+    :param backend: one of TERM_EVAL_BACKENDS. If None, hist is used for short blocks,
+                    otherwise ph4 if available, numpy otherwise. gram and bytepair are never chosen automatically.
+    :param blocklen:
+    :param deg:
+    :return:
+    """
+    if backend is None or backend == 'auto':
+        if hist_fits(blocklen):
+            backend = 'hist'
+        else:
+            backend = 'ph4' if FAST_IMPL_PH4 else 'numpy'
+
+    if backend not in TERM_EVAL_BACKENDS:
+        raise ValueError('Unknown term evaluation backend %s' % backend)
+    if backend == 'ph4' and not FAST_IMPL_PH4:
+        raise ValueError('Backend ph4 requires bitarray_ph4 extension')
+
+    return TERM_EVAL_BACKENDS[backend](blocklen=blocklen, deg=deg, **kwargs)
+
 
 class Tester(object):
     """
@@ -14,13 +14,16 @@ import six
 import sys
 import math
 import heapq
+import itertools
 import random
 import json
 import types
 import collections
+import multiprocessing
 import scipy
 import scipy.misc
 import scipy.stats
+import numpy as np
 
 logger = logging.getLogger(__name__)
 coloredlogs.install(level=logging.DEBUG)
@@ -30,6 +33,9 @@ Combined = collections.namedtuple('Combined', ['poly', 'expp', 'exp_cnt', 'obs_c
 CombinedIdx = collections.namedtuple('CombinedIdx', ['poly', 'expp', 'exp_cnt', 'obs_cnt', 'zscore', 'idx'])
 ValueIdx = collections.namedtuple('ValueIdx', ['value', 'idx'])
 
+# (analysis, top_terms, ref_hws) shared with the forked combination workers
+_FORK_COMB = None
+
 
 def bar_chart(sources=None, values=None, res=None, error=None, xlabel=None, title=None):
     import numpy as np
@@ -53,7 +59,7 @@ class HWAnalysis(object):
     Analysis of all deg poly
     """
     def __init__(self, *args, **kwargs):
-        self.term_map = []
+        self.term_index = None
         self.term_eval = None
         self.ref_term_eval = None
 
@@ -75,10 +81,26 @@ class HWAnalysis(object):
         self.use_zscore_heap = False
         self.sort_best_zscores = -1
         self.best_x_combinations = None  # if a number is here, best combinations are done by heap
+        self.term_eval_backend = None  # basis backend, see common.TERM_EVAL_BACKENDS
+        self.threads = None
+        self.workers = None  # worker processes for all terms evaluation, numpy backend
+        self.comb_workers = None  # worker processes for the combination search
+        self.comb_tasks_per_worker = 8  # combination rank ranges per worker
+        self.comb_min_parallel = 1 << 12  # minimal number of combinations to search in parallel
+        self.comb_beam = None  # beam width, combinations are extended only from the best ones of the lower degree
+        self.comb_block_size = 4096  # number of combinations with expected probabilities computed at once
+        self.expp_cache_size = 4096  # entries of the process-wide expected probability cache
+        self.expp_cache_path = None  # SQLite file backing the expected probability cache, shared across runs
+        self.tile_size = None  # basis tile size in bytes for cache blocked evaluation, numpy backend
+        self.stream_top_deg = False  # top degree HWs are streamed to the top-k accumulator, table is not stored
+        self.cumulative = False  # chunks are only accumulated, analysis runs on the totals, see finished()
+        self.report_rounds = None  # cumulative mode - analyse the totals every report_rounds chunks
 
         self.total_rounds = 0
         self.total_hws = []
         self.ref_total_hws = []
+        self.chunk_hws = None  # HW buffers of the last chunk, reused by the term evaluator
+        self.ref_chunk_hws = None
         self.total_n = 0
         self.last_res = None
 
@@ -94,6 +116,23 @@ class HWAnalysis(object):
         self.comb_res = None
         self.comb_subres = None
 
+        # Top terms evaluated once for the combination stage
+        self.comb_cache = None
+        self.ref_comb_cache = None
+
+        # HW tables the combination counts are looked up in, if comb_from_tables
+        self.comb_from_tables = False
+        self.comb_hws = None
+        self.ref_comb_hws = None
+        self.comb_table_hits = 0
+        self.comb_table_misses = 0  # combinations skipped, counted only from the HW tables but not determined by them
+
+        # HWs of the cached top terms after the checkpoints, bound the combination HWs for the early rejection
+        self.comb_bound_steps = 10
+        self.comb_checkpoints = None
+        self.comb_cache_rest = None
+        self.comb_bound_rejects = 0
+
     def init(self):
         """
         Initializes state, term_eval engine, input polynomials expected probability.
@@ -101,14 +140,24 @@ class HWAnalysis(object):
         """
         logger.info('Initializing HWanalysis')
 
-        if not self.no_term_map:
-            logger.info('Precomputing term mappings')
-            self.term_map = common.build_term_map(self.deg, self.blocklen)
-
-        self.term_eval = common.TermEval(blocklen=self.blocklen, deg=self.deg)
-        self.ref_term_eval = common.TermEval(blocklen=self.blocklen, deg=self.deg)
-        self.total_hws = [[0] * common.comb(self.blocklen, x, True) for x in range(self.deg + 1)]
-        self.ref_total_hws = [[0] * common.comb(self.blocklen, x, True) for x in range(self.deg + 1)]
+        self.term_index = common.TermIndex(self.blocklen, self.deg, use_matrix=not self.no_term_map)
+        common.init_expp_cache(self.expp_cache_size, self.expp_cache_path)
+
+        backend = self.get_backend()
+        self.term_eval = common.get_term_eval(backend, blocklen=self.blocklen, deg=self.deg)
+        self.ref_term_eval = common.get_term_eval(backend, blocklen=self.blocklen, deg=self.deg)
+        for term_eval in [self.term_eval, self.ref_term_eval]:
+            term_eval.threads = self.threads
+            term_eval.workers = self.workers
+            term_eval.tile_size = self.tile_size
+        logger.info('Term evaluation backend: %s' % self.term_eval.__class__.__name__)
+        if self.stream_top_deg and self.do_ref:
+            raise ValueError('Top degree streaming not allowed with ref stream')
+        if self.stream_top_deg and self.cumulative:
+            raise ValueError('Top degree streaming not allowed with cumulative analysis')
+
+        self.total_hws = self.alloc_hws()
+        self.ref_total_hws = self.alloc_hws()
         self.input_poly_exp = [0] * len(self.input_poly)
         self.input_poly_hws = [0] * len(self.input_poly)
         self.input_poly_ref_hws = [0] * len(self.input_poly)
@@ -116,6 +165,34 @@ class HWAnalysis(object):
         if self.best_x_combinations <= 0:
             self.best_x_combinations = None
 
+    def get_backend(self):
+        """
+        Returns term evaluation backend to use.
+        Features implemented only by the numpy backend switch the automatic choice to numpy.
+        Worker processes and tiling do not outweigh the popcount lookup table, without native
+        numpy bitwise_count the automatic choice keeps ph4 for them.
+        :return:
+        """
+        numpy_only = (self.workers is not None and self.workers > 1) or self.tile_size is not None
+        if self.term_eval_backend not in [None, 'auto']:
+            if self.term_eval_backend == 'ph4' and numpy_only:
+                logger.warning('Worker processes and tiling are not supported by the ph4 backend, ignoring')
+            if self.term_eval_backend == 'ph4' and self.stream_top_deg:
+                raise ValueError('Top degree streaming is not supported by the ph4 backend')
+            return self.term_eval_backend
+
+        keep_ph4 = common.FAST_IMPL_PH4 and not common.NP_BITWISE_COUNT and not common.hist_fits(self.blocklen)
+        if numpy_only and keep_ph4 and not self.stream_top_deg:
+            logger.warning('numpy has no native bitwise_count, keeping the ph4 backend, '
+                           'worker processes and tiling are ignored')
+            return 'ph4'
+
+        numpy_only |= self.stream_top_deg
+
+        if numpy_only:
+            return 'hist' if common.hist_fits(self.blocklen) else 'numpy'
+        return self.term_eval_backend
+
     def reset(self):
         """
         Reset internal stats - for use with new test vector set
@@ -123,13 +200,34 @@ class HWAnalysis(object):
         """
         self.total_n = 0
         self.total_rounds = 0
-        self.total_hws = [[0] * common.comb(self.blocklen, x, True) for x in range(self.deg + 1)]
-        self.ref_total_hws = [[0] * common.comb(self.blocklen, x, True) for x in range(self.deg + 1)]
+        self.total_hws = self.alloc_hws()
+        self.ref_total_hws = self.alloc_hws()
         self.input_poly_hws = [0] * len(self.input_poly)
         self.input_poly_ref_hws = [0] * len(self.input_poly)
         self.last_res = None
         self.input_poly_last_res = None
 
+    def alloc_hws(self):
+        """
+        Allocates HW accumulator for all degrees, uint64 numpy arrays.
+        Streamed top degree is not accumulated.
+        :return:
+        """
+        return [np.zeros(common.comb(self.blocklen, x, True) if not (self.stream_top_deg and x == self.deg) else 0,
+                         dtype=np.uint64)
+                for x in range(self.deg + 1)]
+
+    def new_top_terms_acc(self, num_evals):
+        """
+        Creates streaming top-k accumulator for the top degree HWs
+        :param num_evals:
+        :return:
+        """
+        exp_count = num_evals * self.term_eval.expp_term_deg(self.deg)
+        zscore_denom = common.zscore_denominator(exp_count, num_evals)
+        return common.TopTermsAccumulator(k=self.sort_best_zscores, expected=exp_count,
+                                          diff_threshold=self.zscore_thresh * zscore_denom * num_evals)
+
     def precompute_input_poly(self):
         """
         Precompute expected values for input polynomials
@@ -162,21 +260,19 @@ class HWAnalysis(object):
         # Evaluate all terms of degrees 1..deg
         if self.all_deg_compute:
             logger.info('Evaluating all terms, bitlen: %d, bytes: %d' % (ln, ln//8))
-            hws2 = self.term_eval.eval_all_terms(self.deg)
+            if self.stream_top_deg:
+                hws2 = self.term_eval.eval_all_terms(self.deg, sink=self.new_top_terms_acc(self.term_eval.cur_evals),
+                                                     hw=self.chunk_hws)
+            else:
+                hws2 = self.term_eval.eval_all_terms(self.deg, hw=self.chunk_hws)
+            self.chunk_hws = hws2
             logger.info('Done: %s' % [len(x) for x in hws2])
 
-            # Accumulate hws to the results.
-            # If the first round, use the returned array directly to reduce time & memory for copying.
-            if self.total_rounds == 0:
-                self.total_hws = hws2
-                logger.info('HWS merged - move')
-
-            else:
-                for d in range(1, self.deg+1):
-                    for i in common.range2(len(self.total_hws[d])):
-                        self.total_hws[d][i] += hws2[d][i]
-                logger.info('HWS merged - merge')
-            self.total_rounds += 1
+            # Accumulate hws to the results, in place. Streamed top degree is not accumulated.
+            acc_deg = self.deg - 1 if self.stream_top_deg else self.deg
+            for d in range(1, acc_deg+1):
+                np.add(self.total_hws[d], hws2[d], out=self.total_hws[d])
+            logger.info('HWS merged')
 
         # Evaluate given input polynomials
         if len(self.input_poly) > 0:
@@ -189,12 +285,18 @@ class HWAnalysis(object):
                 self.input_poly_hws[idx] += obs_cnt
 
         self.total_n += self.term_eval.cur_evals
+        self.total_rounds += 1
 
         # Reference stream
         ref_hws = self.process_ref(ref_bits, ln)
 
         # Done.
-        self.analyse(num_evals=self.term_eval.cur_evals, hws=hws2, hws_input=hws_input, ref_hws=ref_hws)
+        if not self.cumulative:
+            self.analyse(num_evals=self.term_eval.cur_evals, hws=hws2, hws_input=hws_input, ref_hws=ref_hws)
+
+        elif (self.report_rounds or 0) > 0 and self.total_rounds % self.report_rounds == 0:
+            logger.info('Cumulative report, rounds: %d, evals: %d' % (self.total_rounds, self.total_n))
+            self.analyse_total()
 
     def process_ref(self, ref_bits, ln):
         """
@@ -210,10 +312,10 @@ class HWAnalysis(object):
         logger.info('Evaluating ref data stream')
         if self.all_deg_compute:
             self.ref_term_eval.load(ref_bits)
-            ref_hws = self.ref_term_eval.eval_all_terms(self.deg)
+            ref_hws = self.ref_term_eval.eval_all_terms(self.deg, hw=self.ref_chunk_hws)
+            self.ref_chunk_hws = ref_hws
             for d in range(1, self.deg+1):
-                for i in common.range2(len(self.ref_total_hws[d])):
-                    self.ref_total_hws[d][i] += ref_hws[d][i]
+                np.add(self.ref_total_hws[d], ref_hws[d], out=self.ref_total_hws[d])
             return ref_hws
 
         else:
@@ -221,10 +323,23 @@ class HWAnalysis(object):
 
     def finished(self):
         """
-        All data read - final analysis.
+        All data read - final analysis on the cumulative totals, including the combinations.
+        :return:
+        """
+        if self.total_rounds == 0:
+            return None
+        return self.analyse_total(combine=True)
+
+    def analyse_total(self, combine=False):
+        """
+        Analyses the cumulative HWs of all chunks processed so far.
+        The basis holds only the last chunk, combinations are counted from the HW tables of the totals.
+        :param combine: run the combination stage, only once on the final totals
         :return:
         """
-        return self.analyse(self.total_hws, self.total_n)
+        return self.analyse(num_evals=self.total_n, hws=self.total_hws,
+                            hws_input=self.input_poly_hws if len(self.input_poly) > 0 else None,
+                            ref_hws=self.ref_total_hws if self.do_ref else None, combine=combine)
 
     def tprint(self, *args, **kwargs):
         if self.skip_print_res:
@@ -234,15 +349,21 @@ class HWAnalysis(object):
     def unrank(self, deg, index):
         """
         Converts index to the polynomial of given degree.
-        Uses either memoryzed table or unranking algorithm
+        Uses either term matrix or unranking by the binomial table
         :param deg:
         :param index:
         :return:
         """
-        if self.no_term_map:
-            return common.unrank(index, self.blocklen, deg)
-        else:
-            return self.term_map[deg][index]
+        return self.term_index.term(deg, index)
+
+    def unrank_all(self, deg, indices):
+        """
+        Converts indices to the polynomials of given degree, vectorized.
+        :param deg:
+        :param indices:
+        :return: list of terms
+        """
+        return self.term_index.terms(deg, indices)
 
     def analyse_input(self, num_evals, hws_input=None):
         """
@@ -280,106 +401,158 @@ class HWAnalysis(object):
         :param zscores:
         :return: (zscore mean, number of zscores above threshold)
         """
-        if self.use_zscore_heap and deg > 1:
+        if isinstance(hws[deg], common.TopTermsAccumulator):
+            return self.best_zscored_base_poly_stream(deg, zscores, zscores_ref, num_evals, hws, ref_hws, exp_count)
+        elif self.use_zscore_heap and deg > 1:
             return self.best_zscored_base_poly_heap(deg, zscores, zscores_ref, num_evals, hws, ref_hws, exp_count)
         else:
             return self.best_zscored_base_poly_all(deg, zscores, zscores_ref, num_evals, hws, ref_hws, exp_count)
 
     def best_zscored_base_poly_heap(self, deg, zscores, zscores_ref, num_evals, hws=None, ref_hws=None, exp_count=None):
         """
-        Uses heap to keep X best base distinguishers in the zscores array
+        Keeps X best base distinguishers in the zscores array.
+        Top X is selected by partitioning the HW difference array, ties as in the heap ordering (hw_diff, hw, idx).
         :param deg:
         :param zscores:
         :return: (zscore mean, number of zscores above threshold)
         """
-        logger.info('Find best with heap start deg: %d' % deg)
+        logger.info('Find best with partition start deg: %d' % deg)
         zscore_denom = common.zscore_denominator(exp_count[deg], num_evals)
         if ref_hws is not None:
             raise ValueError('Heap optimization not allowed with ref stream')
 
-        # zscore = hwdiff * 1/num_evals * 1/zscore_denom
-        # zscore mean = \sum_{i=0}^{cnt} (hwdiff) * 1/num_evals * 1/zscore_denom / cnt
-        hw_diff_sum = 0
-
         # threshold zscore = self.zscore_thresh,
         # threshold hw_diff = self.zscore_thresh * zscore_denom * num_evals
         hw_diff_threshold = self.zscore_thresh * zscore_denom * num_evals
-        hw_diff_over = 0
-
-        # After this iteration hp will be a heap with sort_best_zscores elements
-        hp = []
-        hp_size = 0
-        for (idx, hw) in enumerate(hws[deg]):
-            hw_diff = abs(hw - exp_count[deg])
-            hw_diff_sum += hw_diff
-            hw_diff_over += 1 if hw_diff >= hw_diff_threshold else 0
-
-            if self.sort_best_zscores < 0 or hp_size <= self.sort_best_zscores:
-                heapq.heappush(hp, (hw_diff, hw, idx))
-                hp_size += 1
-
-            elif hw_diff > hp[0][0]:   # this difference is larger than minimum in heap
-                heapq.heapreplace(hp, (hw_diff, hw, idx))
-        logger.info('Heap done: %d' % len(hp))
-
-        # zscores[deg] space allocation
-        top_range = min(len(hp), self.sort_best_zscores if self.sort_best_zscores >= 0 else len(hp))
-        if len(zscores[deg]) < top_range:
-            zscores[deg] = [0] * top_range
-
-        # Take n largest from the heap, zscore.
-        # Size of the queue ~ number of elements to sort, using sorted on the heap array is faster.
-        hp.sort(reverse=True)
-        logger.info('Heap sorted, len: %s' % top_range)
-
-        for i in common.range2(top_range):
-            hw_diff, hw, idx = hp[i]
-            zscores[deg][i] = common.zscore_den(hw, exp_count[deg], num_evals, zscore_denom), idx, hw
-
-        # stats
-        total_n = float(len(hws[deg]))
-        zscore_mean = hw_diff_sum / zscore_denom / num_evals / total_n
+
+        cur_hws = np.asarray(hws[deg])
+        hw_diffs = np.abs(cur_hws - exp_count[deg])
+        hw_diff_over = int(np.count_nonzero(hw_diffs >= hw_diff_threshold))
+
+        top_range = len(cur_hws) if self.sort_best_zscores < 0 else min(len(cur_hws), self.sort_best_zscores)
+        top_idx = self.top_diff_indices(hw_diffs, top_range, cur_hws)
+        zscores[deg] = self.zscore_tuples(top_idx, cur_hws, exp_count[deg], num_evals, zscore_denom)
+        logger.info('Top sorted, len: %s' % top_range)
+
+        # stats, zscore mean = \sum_{i=0}^{cnt} (hwdiff) * 1/num_evals * 1/zscore_denom / cnt
+        zscore_mean = float(hw_diffs.sum()) / zscore_denom / num_evals / float(len(cur_hws))
         logger.info('Stats done [%d], mean zscore: %s' % (deg, zscore_mean))
         return zscore_mean, hw_diff_over
 
-    def best_zscored_base_poly_all(self, deg, zscores, zscores_ref, num_evals, hws=None, ref_hws=None, exp_count=None):
+    def best_zscored_base_poly_stream(self, deg, zscores, zscores_ref, num_evals, hws=None, ref_hws=None,
+                                      exp_count=None):
         """
-        Computes all zscores
+        Best X zscores from the streaming top-k accumulator, the HW table was not built
         :param deg:
         :param zscores:
         :return: (zscore mean, number of zscores above threshold)
         """
-        logger.info('Find best with allsort start deg: %d' % deg)
+        logger.info('Find best from the stream deg: %d' % deg)
         zscore_denom = common.zscore_denominator(exp_count[deg], num_evals)
         if ref_hws is not None:
-            zscores_ref[deg] = [common.zscore_den(x, exp_count[deg], num_evals, zscore_denom)
-                                for x in ref_hws[deg]]
+            raise ValueError('Top degree streaming not allowed with ref stream')
 
-            zscores[deg] = [((common.zscore_den(x, exp_count[deg], num_evals, zscore_denom)), idx, x)
-                            for idx, x in enumerate(hws[deg])]  # - zscores_ref[deg][idx]
+        acc = hws[deg]
+        top_idx, top_hws, _ = acc.top()
+        top_range = min(len(top_idx), self.sort_best_zscores if self.sort_best_zscores >= 0 else len(top_idx))
+        zscores[deg] = [(common.zscore_den(top_hws[i], exp_count[deg], num_evals, zscore_denom), int(top_idx[i]),
+                         top_hws[i]) for i in common.range2(top_range)]
 
-            zscores_ref[deg].sort(key=lambda x: abs(x), reverse=True)
+        zscore_mean = acc.diff_sum / zscore_denom / num_evals / float(acc.count)
+        logger.info('Stats done [%d], mean zscore: %s' % (deg, zscore_mean))
+        return zscore_mean, acc.over
 
-        else:
-            zscores[deg] = [(common.zscore_den(x, exp_count[deg], num_evals, zscore_denom), idx, x)
-                            for idx, x in enumerate(hws[deg])]
+    def best_zscored_base_poly_all(self, deg, zscores, zscores_ref, num_evals, hws=None, ref_hws=None, exp_count=None):
+        """
+        Computes all zscores, keeps the sorted prefix needed by the later stages, see zscores_to_keep().
+        :param deg:
+        :param zscores:
+        :return: (zscore mean, number of zscores above threshold)
+        """
+        logger.info('Find best with allsort start deg: %d' % deg)
+        zscore_denom = common.zscore_denominator(exp_count[deg], num_evals)
+        cur_hws = np.asarray(hws[deg])
+        top_range = self.zscores_to_keep(len(cur_hws))
 
+        if ref_hws is not None:
+            ref_zscores = common.zscores_den(np.asarray(ref_hws[deg]), exp_count[deg], num_evals, zscore_denom)
+            ref_idx = self.top_diff_indices(np.abs(ref_zscores), top_range)
+            zscores_ref[deg] = [float(x) for x in ref_zscores[ref_idx]]
+
+        abs_zscores = np.abs(common.zscores_den(cur_hws, exp_count[deg], num_evals, zscore_denom))
         logger.info('Sorting...')
-        zscores[deg].sort(key=lambda x: abs(x[0]), reverse=True)
+        top_idx = self.top_diff_indices(abs_zscores, top_range)
+        zscores[deg] = self.zscore_tuples(top_idx, cur_hws, exp_count[deg], num_evals, zscore_denom)
         logger.info('Sorted... len: %d' % len(zscores[deg]))
 
-        mean_zscore = sum([abs(x[0]) for x in zscores[deg]]) / float(len(zscores[deg]))
-        fails = sum([1 for x in zscores[deg] if abs(x[0]) > self.zscore_thresh])
+        mean_zscore = float(abs_zscores.mean())
+        fails = int(np.count_nonzero(abs_zscores > self.zscore_thresh))
         logger.info('Stats computed [%d], mean zscore: %s' % (deg, mean_zscore))
         return mean_zscore, fails
 
-    def analyse(self, num_evals, hws=None, hws_input=None, ref_hws=None):
+    def zscores_to_keep(self, num_terms):
+        """
+        Number of the best zscores used by the later stages - printing, top_k selection, random selection.
+        :param num_terms:
+        :return:
+        """
+        if self.comb_random is not None and self.comb_random > 0:
+            return num_terms
+
+        keep = 15
+        if self.top_k is not None:
+            keep = num_terms if self.top_k < 0 else max(keep, self.top_k)
+        return min(keep, num_terms)
+
+    def top_diff_indices(self, diffs, k, hws=None):
+        """
+        Indices of k largest differences, sorted descending.
+        Candidates are selected by partitioning, only those are sorted.
+        Ties are broken by hws and index descending if hws is given (heap ordering),
+        by index ascending otherwise (stable sort ordering).
+        :param diffs: numpy array
+        :param k:
+        :param hws: numpy array
+        :return: numpy array of indices
+        """
+        num = len(diffs)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+
+        if k < num:
+            kth = np.partition(diffs, num - k)[num - k]
+            cand = np.flatnonzero(diffs >= kth)
+        else:
+            cand = np.arange(num)
+
+        if hws is not None:
+            order = np.lexsort((cand, hws[cand], diffs[cand]))[::-1]
+        else:
+            order = np.lexsort((cand, -diffs[cand]))
+        return cand[order[:k]]
+
+    def zscore_tuples(self, indices, hws, exp_count, num_evals, zscore_denom):
+        """
+        Builds zscores[deg] entries (zscore, idx, hw) for the given term indices
+        :param indices:
+        :param hws:
+        :param exp_count:
+        :param num_evals:
+        :param zscore_denom:
+        :return:
+        """
+        sel_hws = hws[indices]
+        sel_zscores = common.zscores_den(sel_hws, exp_count, num_evals, zscore_denom)
+        return [(float(z), int(idx), int(hw)) for z, idx, hw in zip(sel_zscores, indices, sel_hws)]
+
+    def analyse(self, num_evals, hws=None, hws_input=None, ref_hws=None, combine=True):
         """
         Analyse hamming weights
         :param num_evals:
         :param hws: hamming weights on results for all degrees
         :param hws_input: hamming weights on results for input polynomials
         :param ref_hws: reference hamming weights
+        :param combine: run the combination stage on the top terms
         :return:
         """
 
@@ -395,8 +568,8 @@ class HWAnalysis(object):
         logger.info('Probabilities: %s, expected count: %s' % (probab, exp_count))
 
         top_terms = []
-        zscores = [[0] * len(x) for x in hws]
-        zscores_ref = [[0] * len(x) for x in hws]
+        zscores = [[] for _ in hws]
+        zscores_ref = [[] for _ in hws]
         start_deg = self.deg if self.do_only_top_deg else 1
         for deg in range(start_deg, self.deg+1):
             # Compute (zscore, idx)
@@ -407,11 +580,13 @@ class HWAnalysis(object):
                                                              hws, ref_hws, exp_count)
 
             # Selecting TOP k polynomials for further combinations
+            best_terms = self.unrank_all(deg, [x[1] for x in zscores[deg][0:15]])
             for idx, x in enumerate(zscores[deg][0:15]):
                 fail = 'x' if abs(x[0]) > self.zscore_thresh else ' '
+                zscore_ref = zscores_ref[deg][idx] if idx < len(zscores_ref[deg]) else 0
                 self.tprint(' - zscore[deg=%d]: %+05.5f, %+05.5f, observed: %08d, expected: %08d %s idx: %6d, term: %s'
-                            % (deg, x[0], zscores_ref[deg][idx]-x[0], x[2],
-                               exp_count[deg], fail, x[1], self.unrank(deg, x[1])))
+                            % (deg, x[0], zscore_ref-x[0], x[2],
+                               exp_count[deg], fail, x[1], best_terms[idx]))
 
             # Take top X best polynomials
             if self.top_k is None:
@@ -419,19 +594,20 @@ class HWAnalysis(object):
 
             logger.info('Comb...')
             if self.combine_all_deg or deg == self.deg:
-                top_terms += [self.unrank(deg, x[1]) for x in zscores[deg][0: (None if self.top_k < 0 else self.top_k)]]
+                top_zscores = zscores[deg][0: (None if self.top_k < 0 else self.top_k)]
+                top_terms += self.unrank_all(deg, [x[1] for x in top_zscores])
 
                 if self.comb_random > 0:
                     random_subset = random.sample(zscores[deg], self.comb_random)
-                    top_terms += [self.unrank(deg, x[1]) for x in random_subset]
+                    top_terms += self.unrank_all(deg, [x[1] for x in random_subset])
 
             logger.info('Stats...')
-            fails_fraction = float(fails)/len(zscores[deg])
+            fails_fraction = float(fails)/len(hws[deg])
 
             self.tprint('Mean zscore[deg=%d]: %s' % (deg, mean_zscore))
             self.tprint('Num of fails[deg=%d]: %s = %02f.5%%' % (deg, fails, 100.0*fails_fraction))
 
-        if self.top_k is None:
+        if self.top_k is None or not combine:
             return
 
         # Combine & store the results - XOR, AND combination
@@ -442,18 +618,54 @@ class HWAnalysis(object):
 
         self.comb_res = self.term_eval.new_buffer()
         self.comb_subres = self.term_eval.new_buffer()
+        self.comb_bound_rejects = 0
+
+        # Cumulative totals are not in the basis, it holds only the last chunk
+        if not self.cumulative:
+            self.comb_cache = self.term_eval.eval_terms_cache(top_terms)
+            self.ref_comb_cache = self.ref_term_eval.eval_terms_cache(top_terms) if ref_hws is not None else None
+
+        # HW bounds reject combinations only against a full heap of the best ones
+        if not self.cumulative and (self.best_x_combinations is not None or self.comb_beam is not None):
+            self.comb_checkpoints = self.comb_bound_checkpoints(num_evals)
+            self.comb_cache_rest = [[self.term_eval.hw_range(x, cp, num_evals) for x in self.comb_cache]
+                                    for cp in self.comb_checkpoints[:-1]]
+
+        self.comb_table_hits = 0
+        self.comb_table_misses = 0
+        if self.comb_from_tables or self.cumulative:
+            self.comb_hws = hws
+            self.ref_comb_hws = ref_hws
         start_deg = self.top_comb if self.do_only_top_comb else 1
-        for top_comb_cur in common.range2(start_deg, self.top_comb + 1):
-
-            # Combine * store results - XOR
+        if self.comb_beam is not None:
             if not self.no_comb_xor:
-                self.comb_xor(top_comb_cur=top_comb_cur, top_terms=top_terms, top_res=top_res, num_evals=num_evals,
-                              ref_hws=ref_hws)
-
-            # Combine & store results - AND
+                self.comb_beam_search(start_deg, top_terms, top_res, num_evals, ref_hws, op_xor=True)
             if not self.no_comb_and:
-                self.comb_and(top_comb_cur=top_comb_cur, top_terms=top_terms, top_res=top_res, num_evals=num_evals,
-                              ref_hws=ref_hws)
+                self.comb_beam_search(start_deg, top_terms, top_res, num_evals, ref_hws, op_xor=False)
+
+        else:
+            for top_comb_cur in common.range2(start_deg, self.top_comb + 1):
+
+                # Combine * store results - XOR
+                if not self.no_comb_xor:
+                    self.comb_xor(top_comb_cur=top_comb_cur, top_terms=top_terms, top_res=top_res,
+                                  num_evals=num_evals, ref_hws=ref_hws)
+
+                # Combine & store results - AND
+                if not self.no_comb_and:
+                    self.comb_and(top_comb_cur=top_comb_cur, top_terms=top_terms, top_res=top_res,
+                                  num_evals=num_evals, ref_hws=ref_hws)
+
+        if self.comb_hws is not None:
+            logger.info('Combinations counted from the HW tables: %d' % self.comb_table_hits)
+        if self.comb_table_misses > 0:
+            logger.warning('Combinations not determined by the HW tables of the totals, skipped: %d'
+                           % self.comb_table_misses)
+        if self.best_x_combinations is not None or self.comb_beam is not None:
+            logger.info('Combinations rejected by the HW bounds: %d' % self.comb_bound_rejects)
+        logger.info('Expected probability cache: %s' % common.get_expp_cache())
+        self.comb_hws = None
+        self.ref_comb_hws = None
 
         logger.info('Evaluating')
         top_res = self.sort_top_res(top_res)
@@ -464,6 +676,10 @@ class HWAnalysis(object):
                         % (comb.zscore, comb.expp, comb.exp_cnt, comb.obs_cnt,
                            100.0 * (comb.exp_cnt - comb.obs_cnt) / comb.exp_cnt, sorted(comb.poly)))
 
+        self.comb_cache = None
+        self.ref_comb_cache = None
+        self.comb_checkpoints = None
+        self.comb_cache_rest = None
         self.last_res = top_res
         return top_res
 
@@ -474,63 +690,357 @@ class HWAnalysis(object):
         :return:
         """
         if self.best_x_combinations is not None:  # de-heapify, project only the comb element.
-            top_res = [x[1] for x in top_res]
+            top_res = [x[-1] for x in top_res]
 
         top_res.sort(key=lambda x: abs(x.zscore), reverse=True)
         return top_res
 
-    def comb_add_result(self, comb, top_res):
+    def comb_add_result(self, comb, top_res, rank=0, keep=None):
         """
         Adds result to the top results.
         Can use heap to optimize eval speed if caller does not require all results.
         :param comb:
         :param top_res:
+        :param rank: rank of the combination, breaks zscore ties in the heap
+        :param keep: heap limit overriding best_x_combinations
         :return:
         """
-        if self.best_x_combinations is None:
+        limit = self.best_x_combinations if keep is None else keep
+        if limit is None:
             top_res.append(comb)
             return
 
         # Using heap to store only top self.best_x_combinations distinguishers here.
         # If comb contains pvalue in the future, compare better pval.
-        new_item = (abs(comb.zscore), comb)
-        if len(top_res) <= self.best_x_combinations:
+        new_item = (abs(comb.zscore), rank, comb)
+        if len(top_res) <= limit:
             heapq.heappush(top_res, new_item)
 
         elif abs(comb.zscore) > top_res[0][0]:  # this difference is larger than minimum in heap
             heapq.heapreplace(top_res, new_item)
 
-    def comb_base(self, top_comb_cur, top_terms, top_res, num_evals, poly_builder, ref_hws=None):
+    def comb_base(self, top_comb_cur, top_terms, top_res, num_evals, poly_builder, ref_hws=None, op_xor=True,
+                  first=0, count=None, places_gen=None, keep=None):
         """
         Base skeleton for generating all combinations from top_terms up to degree top_comb_cur
+        Combinations are evaluated from the cached top term evaluations, comb_cache.
+        Partial results of the combination prefix are kept, consecutive combinations share all but the last term.
         :param top_comb_cur: current degree of the combination
         :param top_terms: top terms buffer to choose terms out of
         :param top_res: top results accumulator to put
         :param num_evals: number of evaluations in this round - zscore computation
         :param poly_builder: function of (places, top_terms) returns a new polynomial
         :param ref_hws: reference results
+        :param op_xor: combination operation, XOR if True, AND otherwise
+        :param first: rank of the first combination to evaluate
+        :param count: number of combinations to evaluate from the first one, all if None
+        :param places_gen: sorted combinations to evaluate instead of all of them, ranked by the position
+        :param keep: heap limit overriding best_x_combinations
         :return:
         """
-        for idx, places in enumerate(common.term_generator(top_comb_cur, len(top_terms) - 1, self.prob_comb)):
+        if count is None and places_gen is None and self.comb_parallel(top_comb_cur, len(top_terms)):
+            return self.comb_base_parallel(top_comb_cur, top_terms, top_res, num_evals, ref_hws, op_xor)
+
+        partial = [self.term_eval.new_buffer() for _ in range(top_comb_cur - 1)]
+        ref_partial = [self.ref_term_eval.new_buffer() for _ in range(top_comb_cur - 1)] if ref_hws is not None else None
+        prev = None
+
+        if places_gen is None:
+            places_gen = common.term_generator(top_comb_cur, len(top_terms) - 1, self.prob_comb,
+                                               first=first, count=count)
+
+        for idx, (places, expp) in enumerate(self.comb_expp_gen(places_gen, top_terms, op_xor)):
             poly = poly_builder(places, top_terms)
-            expp = self.term_eval.expp_poly(poly)
             exp_cnt = num_evals * expp
             if exp_cnt == 0:
                 continue
 
-            obs_cnt = self.term_eval.hw(self.term_eval.eval_poly(poly, res=self.comb_res, subres=self.comb_subres))
-            zscore = common.zscore(obs_cnt, exp_cnt, num_evals)
+            # Counts determined by the HW tables, same degrees are available in both tables
+            obs_cnt = self.comb_table_hw([top_terms[x] for x in places], op_xor, self.comb_hws)
+            ref_obs_cnt = None
+            if obs_cnt is not None:
+                self.comb_table_hits += 1
+                if ref_hws is not None:
+                    ref_obs_cnt = self.comb_table_hw([top_terms[x] for x in places], op_xor, self.ref_comb_hws)
+
+            elif self.comb_cache is None:  # cumulative totals, the HW tables are the only source
+                self.comb_table_misses += 1
+                continue
+
+            else:
+                if ref_hws is not None:
+                    ref_obs_cnt = self.ref_term_eval.combine_cached_hw(self.ref_comb_cache, places, op_xor,
+                                                                       self.comb_res, prev, ref_partial)
+                obs_cnt = self.comb_eval_hw(places, op_xor, exp_cnt, num_evals, top_res, keep, prev, partial,
+                                            ref_obs_cnt)
 
+                # Partial results were updated only if evaluated on the basis
+                prev = places
+
+                # Candidate provably not entering the full heap, counting stopped on a prefix
+                if obs_cnt is None:
+                    self.comb_bound_rejects += 1
+                    continue
+
+            zscore = common.zscore(obs_cnt, exp_cnt, num_evals)
             comb = None
-            if ref_hws is None:
+            if ref_obs_cnt is None:
                 comb = Combined(poly, expp, exp_cnt, obs_cnt, zscore)
             else:
-                ref_obs_cnt = self.ref_term_eval.hw(
-                    self.ref_term_eval.eval_poly(poly, res=self.comb_res, subres=self.comb_subres))
                 zscore_ref = common.zscore(ref_obs_cnt, exp_cnt, num_evals)
                 comb = Combined(poly, expp, exp_cnt, obs_cnt, zscore - zscore_ref)
 
-            self.comb_add_result(comb, top_res)
+            self.comb_add_result(comb, top_res, first + idx, keep)
+
+    def comb_expp_gen(self, places_gen, top_terms, op_xor=True):
+        """
+        Adds expected probabilities to the combinations, computed by blocks of comb_block_size.
+        :param places_gen: combinations generator
+        :param top_terms: top terms buffer to choose terms out of
+        :param op_xor: XOR if True, AND otherwise
+        :return: generator of (places, expp)
+        """
+        block = []
+        for places in itertools.chain(places_gen, [None]):
+            if places is not None:
+                block.append(places)
+            if len(block) == 0 or (places is not None and len(block) < self.comb_block_size):
+                continue
+
+            expps = self.term_eval.expp_comb_block(top_terms, block, op_xor)
+            for idx, places_cur in enumerate(block):
+                yield places_cur, float(expps[idx])
+            block = []
+
+    def comb_beam_search(self, start_deg, top_terms, top_res, num_evals, ref_hws=None, op_xor=True):
+        """
+        Beam search over the combinations of the top terms, for combination degrees too high for comb_base.
+        Only the best comb_beam combinations of degree j are extended by one more top term to degree j+1,
+        the search evaluates at most comb_beam * len(top_terms) combinations per degree.
+
+        :param start_deg: lowest combination degree added to the top results
+        :param top_terms: top terms buffer to choose terms out of
+        :param top_res: top results accumulator to put
+        :param num_evals: number of evaluations in this round - zscore computation
+        :param ref_hws: reference results
+        :param op_xor: combination operation, XOR if True, AND otherwise
+        :return:
+        """
+        # Heap keeps limit + 1 items, beam is taken from the best ones, the rest competes in top_res
+        keep = max(self.comb_beam - 1, self.best_x_combinations or 0)
+        poly_builder = self.comb_poly_builder(op_xor)
+        beam = [[]]
+
+        for top_comb_cur in common.range2(1, self.top_comb + 1):
+            candidates = sorted(set(tuple(sorted(places + [x])) for places in beam
+                                    for x in range(len(top_terms)) if x not in places))
+            candidates = [list(x) for x in candidates]
+            if len(candidates) == 0:
+                break
+
+            deg_res = []
+            self.comb_base(top_comb_cur, top_terms, deg_res, num_evals, poly_builder, ref_hws, op_xor=op_xor,
+                           places_gen=candidates, keep=keep)
+
+            deg_res.sort(key=lambda x: (-x[0], x[1]))
+            beam = [candidates[x[1]] for x in deg_res[:self.comb_beam]]
+            logger.info('Beam search %s, degree %d: %d combinations evaluated'
+                        % ('xor' if op_xor else 'and', top_comb_cur, len(candidates)))
+
+            if top_comb_cur < start_deg:
+                continue
+            for _, rank, comb in sorted(deg_res, key=lambda x: x[1]):
+                self.comb_add_result(comb, top_res, rank)
+
+    def comb_hw_bounds(self, places, op_xor, hws, num_evals):
+        """
+        Bounds HW of the combination of the top terms from HWs of the terms.
+        AND: max(0, sum(hw) - (k-1)N) <= hw <= min(hw)
+        XOR: max(0, max(hw_i - sum(hw_j, j != i))) <= hw <= min(N, sum(hw))
+        :param places: indices of the combined top terms
+        :param op_xor: XOR if True, AND otherwise
+        :param hws: HWs of the top terms
+        :param num_evals: number of evaluations
+        :return: (lower, upper)
+        """
+        term_hws = [hws[x] for x in places]
+        total = sum(term_hws)
+        if not op_xor:
+            return max(0, total - (len(term_hws) - 1) * num_evals), min(term_hws)
+        return max(0, max(2 * x - total for x in term_hws)), min(num_evals, total)
+
+    def comb_bound_checkpoints(self, num_evals):
+        """
+        Sample counts the combination HW is checked at during the prefix counting,
+        N - N/2, N - N/4, ... rounded down to 64 samples, the last one is N.
+        :param num_evals:
+        :return: list of sample counts
+        """
+        res = []
+        for i in range(1, self.comb_bound_steps + 1):
+            cur = ((num_evals - (num_evals >> i)) // 64) * 64
+            if 0 < cur < num_evals and cur not in res:
+                res.append(cur)
+        return res + [num_evals]
+
+    def comb_eval_hw(self, places, op_xor, exp_cnt, num_evals, top_res, keep=None, prev=None, partial=None,
+                     ref_obs_cnt=None):
+        """
+        Evaluates HW of the combination on the basis, comb_cache.
+        If the heap of the best combinations is full the HW is counted by prefixes of the samples.
+        After each prefix the HW is bounded by [count, count + rest bounds], the rest bounds are given by
+        comb_hw_bounds() on the HWs of the terms in the rest of the samples. zscore is monotone in the observed
+        count, if neither bound can beat the heap minimum the counting stops and the combination is rejected.
+        The bounds are exact, the kept results are the same as with the full evaluation.
+
+        :param places: indices of the combined top terms
+        :param op_xor: XOR if True, AND otherwise
+        :param exp_cnt: expected count
+        :param num_evals: number of evaluations
+        :param top_res: top results heap
+        :param keep: heap limit overriding best_x_combinations
+        :param prev: places of the previous combination evaluated with the same partial buffers
+        :param partial: partial buffers for the combination prefixes
+        :param ref_obs_cnt: reference count, the zscore is a difference to the reference zscore
+        :return: HW or None if rejected
+        """
+        limit = self.best_x_combinations if keep is None else keep
+        if limit is None or len(top_res) <= limit:
+            return self.term_eval.combine_cached_hw(self.comb_cache, places, op_xor, self.comb_res, prev, partial)
+
+        # sparse AND combinations are tested against the last term only on the counted prefixes
+        res = self.term_eval.combine_cached_sparse(self.comb_cache, places, op_xor, self.comb_res, prev, partial)
+        zscore_ref = 0.0 if ref_obs_cnt is None else common.zscore(ref_obs_cnt, exp_cnt, num_evals)
+        threshold = top_res[0][0]
+
+        # zscore interval of the width over 2 * threshold cannot be rejected, checkpoints before are skipped
+        max_rest = 2 * threshold * num_evals * common.zscore_denominator(exp_cnt, num_evals)
+
+        obs_cnt = 0
+        start = 0
+        for idx, stop in enumerate(self.comb_checkpoints):
+            if stop < num_evals and num_evals - stop > max_rest:
+                continue
+
+            obs_cnt += self.term_eval.hw_range(res, start, stop)
+            start = stop
+            if stop >= num_evals:
+                break
+
+            lo, hi = self.comb_hw_bounds(places, op_xor, self.comb_cache_rest[idx], num_evals - stop)
+            zscores = [common.zscore(obs_cnt + lo, exp_cnt, num_evals) - zscore_ref,
+                       common.zscore(obs_cnt + hi, exp_cnt, num_evals) - zscore_ref]
+            if max(abs(x) for x in zscores) <= threshold:
+                return None
+        return obs_cnt
+
+    def comb_parallel(self, top_comb_cur, num_top_terms):
+        """
+        Returns True if the combinations are to be searched in the worker processes.
+        Sampled combinations are searched serially, ranges would not follow the serial sampling.
+        Combinations counted only from the HW tables are searched serially too, there is no basis pass to split.
+        :param top_comb_cur:
+        :param num_top_terms:
+        :return:
+        """
+        if self.comb_workers is None or self.comb_workers <= 1 or self.prob_comb < 1.0 or self.comb_cache is None:
+            return False
+        return common.comb(num_top_terms, top_comb_cur, True) >= self.comb_min_parallel
+
+    def comb_base_parallel(self, top_comb_cur, top_terms, top_res, num_evals, ref_hws=None, op_xor=True):
+        """
+        Evaluates all combinations in the worker processes, partitioned by the combination rank ranges.
+        Workers are forked after the top terms are evaluated so they share comb_cache copy-on-write.
+        Each worker keeps its own top results, these are merged here in the rank order so the result
+        is the same as the serial comb_base.
+
+        :param top_comb_cur: current degree of the combination
+        :param top_terms: top terms buffer to choose terms out of
+        :param top_res: top results accumulator to put
+        :param num_evals: number of evaluations in this round - zscore computation
+        :param ref_hws: reference results
+        :param op_xor: combination operation, XOR if True, AND otherwise
+        :return:
+        """
+        global _FORK_COMB
+        _FORK_COMB = (self, top_terms, ref_hws)
+
+        total = common.comb(len(top_terms), top_comb_cur, True)
+        num_tasks = min(total, self.comb_workers * self.comb_tasks_per_worker)
+        bounds = [total * i // num_tasks for i in range(num_tasks + 1)]
+        tasks = [(top_comb_cur, op_xor, num_evals, bounds[i], bounds[i + 1] - bounds[i]) for i in range(num_tasks)]
+
+        ctx = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+        pool = ctx.Pool(self.comb_workers)
+        try:
+            results = []
+            for task_res, table_hits, bound_rejects, expp_stats in pool.imap(_comb_range_worker, tasks):
+                results += task_res
+                self.comb_table_hits += table_hits
+                self.comb_bound_rejects += bound_rejects
+                common.get_expp_cache().add_stats(expp_stats)
+        finally:
+            pool.close()
+            pool.join()
+            _FORK_COMB = None
+
+        if self.best_x_combinations is None:
+            top_res += results
+            return
+
+        # Replay the worker heaps in the serial order, same ties are kept
+        results.sort(key=lambda x: x[1])
+        for _, rank, comb in results:
+            self.comb_add_result(comb, top_res, rank)
+
+    def comb_poly_builder(self, op_xor):
+        """
+        Returns the polynomial builder for the combination operation
+        :param op_xor: XOR if True, AND otherwise
+        :return: function of (places, top_terms) returns a new polynomial
+        """
+        if op_xor:
+            return lambda places, top_terms: [top_terms[x] for x in places]
+        return lambda places, top_terms: [reduce(lambda x, y: x + y, [top_terms[x] for x in places])]
+
+    def table_term_hw(self, term, hws):
+        """
+        Looks up HW of the monomial in the HW tables.
+        :param term: sorted list of distinct variables
+        :param hws: hws[deg][rank]
+        :return: HW or None if the degree is not in the tables
+        """
+        deg = len(term)
+        if deg == 0 or deg > self.deg or deg >= len(hws):
+            return None
+        if not isinstance(hws[deg], np.ndarray):  # streamed top degree, TopTermsAccumulator
+            return None
+        return int(hws[deg][self.term_index.rank_term(term)])
+
+    def comb_table_hw(self, terms, op_xor, hws):
+        """
+        Computes HW of the combination of terms from the HW tables, without the data pass.
+        AND of terms is the monomial of their union.
+        XOR by inclusion-exclusion, HW(t1 ^ t2) = HW(t1) + HW(t2) - 2 HW(t1 t2), in general
+        HW(t1 ^ ... ^ tk) = sum over nonempty subsets S of (-2)^(|S|-1) HW(AND of S).
+        :param terms: combined terms
+        :param op_xor: XOR if True, AND otherwise
+        :param hws: HW tables, None if disabled
+        :return: HW or None if some required monomial is not in the tables
+        """
+        if hws is None:
+            return None
+        if not op_xor:
+            return self.table_term_hw(sorted(set().union(*terms)), hws)
+
+        res = 0
+        for mask in range(1, 1 << len(terms)):
+            subset = [terms[i] for i in range(len(terms)) if mask & (1 << i)]
+            hw = self.table_term_hw(sorted(set().union(*subset)), hws)
+            if hw is None:
+                return None
+            res += (-2) ** (len(subset) - 1) * hw
+        return res
 
     def comb_xor(self, top_comb_cur, top_terms, top_res, num_evals, ref_hws=None):
         """
@@ -542,7 +1052,7 @@ class HWAnalysis(object):
         :param ref_hws: reference results
         :return:
         """
-        poly_builder = lambda places, top_terms: [top_terms[x] for x in places]
+        poly_builder = self.comb_poly_builder(True)
         return self.comb_base(top_comb_cur, top_terms, top_res, num_evals, poly_builder, ref_hws)
 
     def comb_and(self, top_comb_cur, top_terms, top_res, num_evals, ref_hws=None):
@@ -555,8 +1065,32 @@ class HWAnalysis(object):
         :param ref_hws: reference results
         :return:
         """
-        poly_builder = lambda places, top_terms: [reduce(lambda x, y: x + y, [top_terms[x] for x in places])]
-        return self.comb_base(top_comb_cur, top_terms, top_res, num_evals, poly_builder, ref_hws)
+        poly_builder = self.comb_poly_builder(False)
+        return self.comb_base(top_comb_cur, top_terms, top_res, num_evals, poly_builder, ref_hws, op_xor=False)
+
+
+def _comb_range_worker(task):
+    """
+    Worker process - evaluates a range of combinations on the forked analysis.
+    :param task: (top_comb_cur, op_xor, num_evals, first, count)
+    :return: (top results of the range, number of combinations counted from the HW tables,
+              number of combinations rejected by the HW bounds, expected probability cache stats of the range)
+    """
+    top_comb_cur, op_xor, num_evals, first, count = task
+    analysis, top_terms, ref_hws = _FORK_COMB
+    expp_cache = common.get_expp_cache()
+    expp_stats = expp_cache.stats()
+
+    top_res = []
+    analysis.comb_table_hits = 0
+    analysis.comb_bound_rejects = 0
+    analysis.comb_base(top_comb_cur, top_terms, top_res, num_evals, analysis.comb_poly_builder(op_xor), ref_hws,
+                       op_xor=op_xor, first=first, count=count)
+
+    # forked workers exit without atexit handlers
+    expp_cache.flush()
+    expp_stats = tuple(x - y for x, y in zip(expp_cache.stats(), expp_stats))
+    return top_res, analysis.comb_table_hits, analysis.comb_bound_rejects, expp_stats
 
 
 # Main - argument parsing + processing
@@ -816,6 +1350,18 @@ class App(object):
             hwanalysis.use_zscore_heap = self.args.topterm_heap
             hwanalysis.sort_best_zscores = max(self.args.topterm_heap_k, top_k, 100)
             hwanalysis.best_x_combinations = self.args.best_x_combinations
+            hwanalysis.term_eval_backend = self.args.backend
+            hwanalysis.threads = self.args.threads
+            hwanalysis.workers = self.args.workers
+            hwanalysis.comb_workers = self.args.comb_workers
+            hwanalysis.comb_beam = self.args.comb_beam
+            hwanalysis.expp_cache_size = self.args.expp_cache_size
+            hwanalysis.expp_cache_path = self.args.expp_cache
+            hwanalysis.tile_size = self.process_size(self.args.tile_size)
+            hwanalysis.stream_top_deg = self.args.stream_top
+            hwanalysis.cumulative = self.args.cumulative
+            hwanalysis.report_rounds = self.args.report_rounds
+            hwanalysis.comb_from_tables = self.args.comb_tables
 
             # compute classical analysis only if there are no input polynomials
             hwanalysis.all_deg_compute = len(self.input_poly) == 0
@@ -858,6 +1404,9 @@ class App(object):
                     cur_round += 1
                 pass
 
+            if hwanalysis.cumulative:
+                hwanalysis.finished()
+
             logger.info('Finished processing %s ' % iobj)
             logger.info('Data read %s ' % iobj.data_read)
             logger.info('Read data hash %s ' % iobj.sha1.hexdigest())
@@ -931,7 +1480,7 @@ class App(object):
                                  'also lower degrees are input to the topk for next state - combinations')
 
         parser.add_argument('--no-term-map', dest='no_term_map', action='store_const', const=True, default=False,
-                            help='Disables term map precomputation, uses unranking algorithm instead')
+                            help='Disables term matrices, terms are unranked from the binomial table instead')
 
         parser.add_argument('--topterm-heap', dest='topterm_heap', action='store_const', const=True, default=False,
                             help='Use heap to compute best X terms for stats & input to the combinations')
@@ -942,6 +1491,46 @@ class App(object):
         parser.add_argument('--best-x-combs', dest='best_x_combinations', default=None, type=int,
                             help='Number of best combinations to return. If defined, heap is used')
 
+        parser.add_argument('--backend', dest='backend', default=None,
+                            choices=['auto', 'ph4', 'numpy', 'hist', 'gram', 'bytepair'],
+                            help='Term evaluation backend. Auto uses hist for blocks up to 24 bits, '
+                                 'otherwise ph4 if bitarray_ph4 is available. '
+                                 'Gram computes degree 2 and 3 by matrix products, faster than ph4 only below '
+                                 'about 5000 samples per chunk, '
+                                 'bytepair terms within two bytes from byte pair histograms')
+
+        parser.add_argument('--workers', dest='workers', default=None, type=int,
+                            help='Number of worker processes evaluating the terms, numpy backend')
+
+        parser.add_argument('--expp-cache-size', dest='expp_cache_size', default=4096, type=int,
+                            help='Number of expected probabilities cached in memory')
+
+        parser.add_argument('--expp-cache', dest='expp_cache', default=None,
+                            help='SQLite file caching expected probabilities across runs')
+
+        parser.add_argument('--comb-beam', dest='comb_beam', default=None, type=int,
+                            help='Beam search width for the combinations, only the best combinations are extended '
+                                 'to the next degree')
+
+        parser.add_argument('--comb-workers', dest='comb_workers', default=None, type=int,
+                            help='Number of worker processes searching the combinations')
+
+        parser.add_argument('--tile', dest='tile_size', default=None,
+                            help='Basis tile size for cache blocked term evaluation (e.g., 2Mi), numpy backend')
+
+        parser.add_argument('--stream-top', dest='stream_top', action='store_const', const=True, default=False,
+                            help='Do not store HWs of the top degree terms, keep only --topterm-heap-k best terms '
+                                 'and running stats, numpy backend')
+        parser.add_argument('--cumulative', dest='cumulative', action='store_const', const=True, default=False,
+                            help='Chunks only accumulate HWs, analysis runs once on the totals after all data '
+                                 'is read. Combinations are counted from the HW tables of the totals, '
+                                 'those needing monomials above --degree are skipped')
+        parser.add_argument('--report-rounds', dest='report_rounds', default=None, type=int,
+                            help='Cumulative mode - analyse the totals also every N rounds')
+        parser.add_argument('--comb-tables', dest='comb_tables', action='store_const', const=True, default=False,
+                            help='Count combinations whose monomials are all of degree up to --degree '
+                                 'from the HW tables instead of the data')
+
         parser.add_argument('--prob-comb', dest='prob_comb', type=float, default=1.0,
                             help='Probability the given combination is going to be chosen.')
 
@@ -443,6 +443,18 @@ class TestbedBenchmark(App):
         hwanalysis.use_zscore_heap = self.args.topterm_heap
         hwanalysis.sort_best_zscores = max(self.args.topterm_heap_k, self.top_k, 100)
         hwanalysis.best_x_combinations = self.args.best_x_combinations
+        hwanalysis.term_eval_backend = self.args.backend
+        hwanalysis.threads = self.args.threads
+        hwanalysis.workers = self.args.workers
+        hwanalysis.comb_workers = self.args.comb_workers
+        hwanalysis.comb_beam = self.args.comb_beam
+        hwanalysis.expp_cache_size = self.args.expp_cache_size
+        hwanalysis.expp_cache_path = self.args.expp_cache
+        hwanalysis.tile_size = self.process_size(self.args.tile_size)
+        hwanalysis.stream_top_deg = self.args.stream_top
+        hwanalysis.cumulative = self.args.cumulative
+        hwanalysis.report_rounds = self.args.report_rounds
+        hwanalysis.comb_from_tables = self.args.comb_tables
 
         logger.info('Initializing test')
         time_test_start = time.time()
@@ -489,6 +501,9 @@ class TestbedBenchmark(App):
                 cur_round += 1
             pass
 
+        if hwanalysis.cumulative:
+            hwanalysis.finished()
+
         # RESULT process...
         total_results = len(hwanalysis.last_res)
         best_dists = hwanalysis.last_res[0 : min(128, total_results)]
@@ -566,7 +581,7 @@ class TestbedBenchmark(App):
                                  'also lower degrees are input to the topk for next state - combinations')
 
         parser.add_argument('--no-term-map', dest='no_term_map', action='store_const', const=True, default=False,
-                            help='Disables term map precomputation, uses unranking algorithm instead')
+                            help='Disables term matrices, terms are unranked from the binomial table instead')
 
         parser.add_argument('--prob-comb', dest='prob_comb', type=float, default=1.0,
                             help='Probability the given combination is going to be chosen.')
@@ -580,6 +595,46 @@ class TestbedBenchmark(App):
         parser.add_argument('--best-x-combs', dest='best_x_combinations', default=None, type=int,
                             help='Number of best combinations to return. If defined, heap is used')
 
+        parser.add_argument('--backend', dest='backend', default=None,
+                            choices=['auto', 'ph4', 'numpy', 'hist', 'gram', 'bytepair'],
+                            help='Term evaluation backend. Auto uses hist for blocks up to 24 bits, '
+                                 'otherwise ph4 if bitarray_ph4 is available. '
+                                 'Gram computes degree 2 and 3 by matrix products, faster than ph4 only below '
+                                 'about 5000 samples per chunk, '
+                                 'bytepair terms within two bytes from byte pair histograms')
+
+        parser.add_argument('--workers', dest='workers', default=None, type=int,
+                            help='Number of worker processes evaluating the terms, numpy backend')
+
+        parser.add_argument('--expp-cache-size', dest='expp_cache_size', default=4096, type=int,
+                            help='Number of expected probabilities cached in memory')
+
+        parser.add_argument('--expp-cache', dest='expp_cache', default=None,
+                            help='SQLite file caching expected probabilities across runs')
+
+        parser.add_argument('--comb-beam', dest='comb_beam', default=None, type=int,
+                            help='Beam search width for the combinations, only the best combinations are extended '
+                                 'to the next degree')
+
+        parser.add_argument('--comb-workers', dest='comb_workers', default=None, type=int,
+                            help='Number of worker processes searching the combinations')
+
+        parser.add_argument('--tile', dest='tile_size', default=None,
+                            help='Basis tile size for cache blocked term evaluation (e.g., 2Mi), numpy backend')
+
+        parser.add_argument('--stream-top', dest='stream_top', action='store_const', const=True, default=False,
+                            help='Do not store HWs of the top degree terms, keep only --topterm-heap-k best terms '
+                                 'and running stats, numpy backend')
+        parser.add_argument('--cumulative', dest='cumulative', action='store_const', const=True, default=False,
+                            help='Chunks only accumulate HWs, analysis runs once on the totals after all data '
+                                 'is read. Combinations are counted from the HW tables of the totals, '
+                                 'those needing monomials above --degree are skipped')
+        parser.add_argument('--report-rounds', dest='report_rounds', default=None, type=int,
+                            help='Cumulative mode - analyse the totals also every N rounds')
+        parser.add_argument('--comb-tables', dest='comb_tables', action='store_const', const=True, default=False,
+                            help='Count combinations whose monomials are all of degree up to --degree '
+                                 'from the HW tables instead of the data')
+
         #
         # Testbed related options
         #